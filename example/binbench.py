@@ -0,0 +1,81 @@
+#! /usr/bin/python
+
+import os
+import sys
+
+def _release_path_test(curpath,*paths):
+    testfile = os.path.join(curpath,*paths)
+    if os.path.exists(testfile):
+        if curpath != sys.path[0]:
+            if curpath in sys.path:
+                sys.path.remove(curpath)
+            oldpath=sys.path
+            sys.path = [curpath]
+            sys.path.extend(oldpath)
+    return
+
+def _reload_cmdpack_path(curpath):
+	return _release_path_test(curpath,'cmdpack','__init__.py')
+
+def _reload_cmdpack_debug_path(curpath):
+	return _release_path_test(curpath,'__init_debug__.py')
+
+
+_reload_cmdpack_path(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+_reload_cmdpack_debug_path(os.path.abspath(os.path.join(os.path.dirname(__file__),'..','src','cmdpack')))
+try:
+	import cmdpack
+except ImportError:
+	import __init_debug__ as cmdpack
+import time
+import hashlib
+
+def bench_mode(lines,binary,linebuf):
+	cmds = []
+	cmds.append('%s'%(sys.executable))
+	cmds.append(__file__)
+	cmds.append('cmdout')
+	cmds.append('%d'%(lines))
+	stime = time.time()
+	md = hashlib.md5()
+	items = 0
+	p = cmdpack.run_cmd_output(cmds,linebuf=linebuf,chunksize=0,binary=binary)
+	for l in p:
+		if not binary:
+			# the text path has to encode again to hash
+			l = l.encode('UTF-8')
+		md.update(l)
+		items += 1
+	p.get_exitcode()
+	etime = time.time()
+	sys.stdout.write('binary [%-5s] linebuf [%-5s] [%d] items [%.3f]s md5 [%s]\n'%(binary,linebuf,items,(etime - stime),md.hexdigest()))
+	return
+
+def cmdoutput(args):
+	lines = int(args[0])
+	fout = sys.stdout
+	if sys.version[0] == '3':
+		fout = sys.stdout.buffer
+	i = 0
+	while i < lines:
+		fout.write(b'line with some text to hash and compress %d\n'%(i))
+		i += 1
+	fout.flush()
+	sys.exit(0)
+	return
+
+def main():
+	if len(sys.argv) >= 2 and sys.argv[1] == 'cmdout':
+		cmdoutput(sys.argv[2:])
+		return
+	lines = 200000
+	if len(sys.argv) >= 2:
+		lines = int(sys.argv[1])
+	bench_mode(lines,False,True)
+	bench_mode(lines,True,True)
+	bench_mode(lines,False,False)
+	bench_mode(lines,True,False)
+	return
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,138 @@
+#! /usr/bin/python
+
+import os
+import sys
+
+def _release_path_test(curpath,*paths):
+    testfile = os.path.join(curpath,*paths)
+    if os.path.exists(testfile):
+        if curpath != sys.path[0]:
+            if curpath in sys.path:
+                sys.path.remove(curpath)
+            oldpath=sys.path
+            sys.path = [curpath]
+            sys.path.extend(oldpath)
+    return
+
+def _reload_cmdpack_path(curpath):
+	return _release_path_test(curpath,'cmdpack','__init__.py')
+
+def _reload_cmdpack_debug_path(curpath):
+	return _release_path_test(curpath,'__init_debug__.py')
+
+
+_reload_cmdpack_path(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+_reload_cmdpack_debug_path(os.path.abspath(os.path.join(os.path.dirname(__file__),'..','src','cmdpack')))
+try:
+	import cmdpack
+except ImportError:
+	import __init_debug__ as cmdpack
+import time
+import threading
+import subprocess
+try:
+	import Queue
+except ImportError:
+	import queue as Queue
+
+def old_trans_to_string(s):
+	if sys.version[0] == '3':
+		encodetype = ['UTF-8','latin-1']
+		idx=0
+		while idx < len(encodetype):
+			try:
+				return s.decode(encoding=encodetype[idx])
+			except:
+				idx += 1
+		raise Exception('not valid bytes (%s)'%(repr(s)))
+	return s
+
+def old_enqueue_output(out,queue,description,infoobj):
+	while True:
+		line = out.read(1)
+		infoobj.info('read no line feed [%s][%s]'%(description,line))
+		if line is None or len(line) == 0:
+			break
+		transline = old_trans_to_string(line)
+		queue.put(transline)
+	queue.put(None)
+	return
+
+def old_run_cmd_output(cmds):
+	infoobj = cmdpack._LoggerObject('cmdpack')
+	p = subprocess.Popen(cmds,stdout=subprocess.PIPE,bufsize=0)
+	q = Queue.Queue()
+	t = threading.Thread(target=old_enqueue_output,args=(p.stdout,q,'stdout',infoobj))
+	t.start()
+	while True:
+		l = q.get()
+		if l is None:
+			break
+		yield l
+	t.join()
+	p.stdout.close()
+	p.wait()
+	return
+
+def get_bench_cmds(size):
+	cmds = []
+	cmds.append('%s'%(sys.executable))
+	cmds.append(__file__)
+	cmds.append('cmdout')
+	cmds.append('%d'%(size))
+	return cmds
+
+def bench_old(size):
+	cmds = get_bench_cmds(size)
+	stime = time.time()
+	total = 0
+	items = 0
+	for l in old_run_cmd_output(cmds):
+		total += len(l)
+		items += 1
+	etime = time.time()
+	sys.stdout.write('old read(1)       read [%d] bytes in [%d] items [%.3f]s [%.2f] MB/s\n'%(total,items,(etime - stime),(total / (etime - stime)) / (1024.0 * 1024.0)))
+	return
+
+def bench_chunk(size,chunksize):
+	cmds = get_bench_cmds(size)
+	stime = time.time()
+	total = 0
+	items = 0
+	p = cmdpack.run_cmd_output(cmds,linebuf=False,chunksize=chunksize)
+	for l in p:
+		total += len(l)
+		items += 1
+	p.get_exitcode()
+	etime = time.time()
+	sys.stdout.write('chunksize [%6d] read [%d] bytes in [%d] items [%.3f]s [%.2f] MB/s\n'%(chunksize,total,items,(etime - stime),(total / (etime - stime)) / (1024.0 * 1024.0)))
+	return
+
+def cmdoutput(args):
+	size = int(args[0])
+	fout = sys.stdout
+	if sys.version[0] == '3':
+		fout = sys.stdout.buffer
+	blk = b'x' * 4096
+	while size > 0:
+		cursize = min(size,len(blk))
+		fout.write(blk[:cursize])
+		size -= cursize
+	fout.flush()
+	sys.exit(0)
+	return
+
+def main():
+	if len(sys.argv) >= 2 and sys.argv[1] == 'cmdout':
+		cmdoutput(sys.argv[2:])
+		return
+	size = 4 * 1024 * 1024
+	if len(sys.argv) >= 2:
+		size = int(sys.argv[1])
+	bench_old(size)
+	bench_chunk(size,1)
+	bench_chunk(size,65536)
+	return
+
+if __name__ == '__main__':
+	main()
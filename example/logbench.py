@@ -0,0 +1,81 @@
+#! /usr/bin/python
+
+import os
+import sys
+
+def _release_path_test(curpath,*paths):
+    testfile = os.path.join(curpath,*paths)
+    if os.path.exists(testfile):
+        if curpath != sys.path[0]:
+            if curpath in sys.path:
+                sys.path.remove(curpath)
+            oldpath=sys.path
+            sys.path = [curpath]
+            sys.path.extend(oldpath)
+    return
+
+def _reload_cmdpack_path(curpath):
+	return _release_path_test(curpath,'cmdpack','__init__.py')
+
+def _reload_cmdpack_debug_path(curpath):
+	return _release_path_test(curpath,'__init_debug__.py')
+
+
+_reload_cmdpack_path(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+_reload_cmdpack_debug_path(os.path.abspath(os.path.join(os.path.dirname(__file__),'..','src','cmdpack')))
+try:
+	import cmdpack
+except ImportError:
+	import __init_debug__ as cmdpack
+import time
+import logging
+
+def old_info(logger,msg,callstack=1):
+	# what _LoggerObject.info did before the level check
+	inmsg = msg
+	if callstack is not None:
+		try:
+			frame = sys._getframe(callstack)
+			inmsg = '[%-10s:%-20s:%-5s] '%(frame.f_code.co_filename,frame.f_code.co_name,frame.f_lineno) + msg
+		except:
+			inmsg = msg
+	return logger.info('%s'%(inmsg))
+
+def bench(name,fn,lines):
+	stime = time.time()
+	for l in lines:
+		fn(l)
+	etime = time.time()
+	sys.stdout.write('%-8s [%d] lines [%.3f]s each [%.3f]us\n'%(name,len(lines),(etime - stime),(etime - stime) * 1000000.0 / len(lines)))
+	return
+
+def main():
+	num = 200000
+	if len(sys.argv) >= 2:
+		num = int(sys.argv[1])
+	logobj = cmdpack._LoggerObject('cmdpack')
+	logger = logging.getLogger('cmdpack')
+	lines = ['line %d of the output with some words in it\n'%(i) for i in range(num)]
+	if logger.isEnabledFor(logging.INFO):
+		sys.stderr.write('unset CMDPACK_LOGLEVEL to measure the disabled cost\n')
+		sys.exit(3)
+	def eager_fn(l):
+		old_info(logger,'read [%s][%s]'%('stdout',l))
+		return
+	def lazy_fn(l):
+		logobj.info('read [%s][%s]','stdout',l)
+		return
+	def guard_fn(l):
+		if cmdpack._hot_logging:
+			logobj.info('read [%s][%s]','stdout',l)
+		return
+	def none_fn(l):
+		return
+	bench('eager',eager_fn,lines)
+	bench('lazy',lazy_fn,lines)
+	bench('guard',guard_fn,lines)
+	bench('none',none_fn,lines)
+	return
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,109 @@
+#! /usr/bin/python
+
+import os
+import sys
+
+def _release_path_test(curpath,*paths):
+    testfile = os.path.join(curpath,*paths)
+    if os.path.exists(testfile):
+        if curpath != sys.path[0]:
+            if curpath in sys.path:
+                sys.path.remove(curpath)
+            oldpath=sys.path
+            sys.path = [curpath]
+            sys.path.extend(oldpath)
+    return
+
+def _reload_cmdpack_path(curpath):
+	return _release_path_test(curpath,'cmdpack','__init__.py')
+
+def _reload_cmdpack_debug_path(curpath):
+	return _release_path_test(curpath,'__init_debug__.py')
+
+
+_reload_cmdpack_path(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+_reload_cmdpack_debug_path(os.path.abspath(os.path.join(os.path.dirname(__file__),'..','src','cmdpack')))
+try:
+	import cmdpack
+except ImportError:
+	import __init_debug__ as cmdpack
+import time
+import random
+
+def old_shell_quote_string(s):
+	rets = ''
+	plat = sys.platform.lower()
+	infoobj = cmdpack._LoggerObject('cmdpack')
+	idx = 0
+	while idx < len(s):
+		c = s[idx]
+		if c == '"':
+			adds = '\\"'
+			infoobj.info('add (%s)'%(adds))
+		elif c == '`':
+			if plat == 'win32':
+				adds = '`'
+			else:
+				adds = '\\`'
+		elif c == '\\':
+			if plat == 'win32':
+				if (idx + 1) == len(s):
+					adds = '\\\\'
+				else:
+					adds = '\\'
+			else:
+				adds = '\\\\'
+		else:
+			adds = c
+		rets += adds
+		idx += 1
+	return rets
+
+def old_format_list_to_shell_cmd(cmd):
+	rets = ''
+	for c in cmd:
+		if len(rets) > 0:
+			rets += ' '
+		rets += '"%s"'%(old_shell_quote_string(c))
+	return rets
+
+def make_args(num):
+	args = []
+	chars = 'abcdefghijklmnopqrstuvwxyz/._-"`\\ '
+	random.seed(num)
+	i = 0
+	while i < num:
+		l = random.randint(10,60)
+		args.append(''.join([random.choice(chars) for j in range(l)]))
+		i += 1
+	return args
+
+def bench(name,fn,args,times):
+	stime = time.time()
+	i = 0
+	while i < times:
+		s = fn(args)
+		i += 1
+	etime = time.time()
+	sys.stdout.write('%-10s [%d] args [%d] times [%.3f]s each [%.3f]ms\n'%(name,len(args),times,(etime - stime),(etime - stime) * 1000.0 / times))
+	return s
+
+def main():
+	num = 10000
+	if len(sys.argv) >= 2:
+		num = int(sys.argv[1])
+	args = make_args(num)
+	olds = bench('old',old_format_list_to_shell_cmd,args,3)
+	news = bench('new',cmdpack.format_list_to_shell_cmd,args,3)
+	# the same paths quoted again, as xargs batches often repeat
+	args = args[:2000] * 5
+	bench('old repeat',old_format_list_to_shell_cmd,args,3)
+	bench('new repeat',cmdpack.format_list_to_shell_cmd,args,3)
+	if olds != news:
+		sys.stderr.write('output not same\n')
+		sys.exit(3)
+	sys.stdout.write('output same\n')
+	return
+
+if __name__ == '__main__':
+	main()
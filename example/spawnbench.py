@@ -0,0 +1,68 @@
+#! /usr/bin/python
+
+import os
+import sys
+
+def _release_path_test(curpath,*paths):
+    testfile = os.path.join(curpath,*paths)
+    if os.path.exists(testfile):
+        if curpath != sys.path[0]:
+            if curpath in sys.path:
+                sys.path.remove(curpath)
+            oldpath=sys.path
+            sys.path = [curpath]
+            sys.path.extend(oldpath)
+    return
+
+def _reload_cmdpack_path(curpath):
+	return _release_path_test(curpath,'cmdpack','__init__.py')
+
+def _reload_cmdpack_debug_path(curpath):
+	return _release_path_test(curpath,'__init_debug__.py')
+
+
+_reload_cmdpack_path(os.path.abspath(os.path.join(os.path.dirname(__file__),'..')))
+_reload_cmdpack_debug_path(os.path.abspath(os.path.join(os.path.dirname(__file__),'..','src','cmdpack')))
+try:
+	import cmdpack
+except ImportError:
+	import __init_debug__ as cmdpack
+import time
+
+def make_heap(mbytes):
+	# many small objects, so the page tables of the parent are big too
+	heap = []
+	i = 0
+	while i < mbytes:
+		heap.append([bytearray(1024) for j in range(1024)])
+		i += 1
+	return heap
+
+def bench_spawn(launcher,times):
+	stime = time.time()
+	i = 0
+	while i < times:
+		p = cmdpack.run_cmd_output(['true'],launcher=launcher)
+		for l in p:
+			pass
+		p.get_exitcode()
+		i += 1
+	etime = time.time()
+	sys.stdout.write('launcher [%-5s] [%d] spawns [%.3f]s [%.1f] spawns/s\n'%(launcher,times,(etime - stime),times / (etime - stime)))
+	return
+
+def main():
+	mbytes = 2048
+	times = 200
+	if len(sys.argv) >= 2:
+		mbytes = int(sys.argv[1])
+	if len(sys.argv) >= 3:
+		times = int(sys.argv[2])
+	heap = make_heap(mbytes)
+	sys.stdout.write('parent heap [%d] MB\n'%(mbytes))
+	bench_spawn('popen',times)
+	bench_spawn('spawn',times)
+	return
+
+if __name__ == '__main__':
+	main()
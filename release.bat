@@ -16,6 +16,7 @@ if -%PYTHON%- == -- (
 
 %PYTHON% %script_dir%src\%packagename%\__init_debug__.py --release  %script_dir%%packagename%\__init__.py
 call :check_file %script_dir%%packagename%\__init__.py.touched
+copy /Y %script_dir%src\%packagename%\aio.py %script_dir%%packagename%\aio.py >NUL
 
 
 %PYTHON% %script_dir%test\release\releasetest.py release --release-output %script_dir%test\release\release.py
@@ -50,6 +50,7 @@ rm -f $script_dir/test/release/release.py.touched
 $PYTHON $script_dir/make_setup.py
 $PYTHON $script_dir/src/$packagename/__init_debug__.py --release $script_dir/$packagename/__init__.py
 wait_file_until "$script_dir/$packagename/__init__.py.touched"
+cp -f $script_dir/src/$packagename/aio.py $script_dir/$packagename/aio.py
 
 $PYTHON $script_dir/test/release/releasetest.py release
 wait_file_until "$script_dir/test/release/release.py.touched"
@@ -7,42 +7,98 @@ import logging
 import time
 import threading
 import re
+import signal
+import codecs
+import errno
+import collections
+import functools
+import weakref
 try:
-    import Queue
+    import selectors
 except ImportError:
-    import queue as Queue
+    selectors = None
+try:
+    import concurrent.futures as futures
+except ImportError:
+    futures = None
 
 __version__ = "VERSIONNUMBER"
 __version_info__ = "VERSIONINFO"
 
+# logging in the per chunk paths is only kept when the cmdpack logger takes INFO
+_hot_logging = ('CMDPACK_LOGLEVEL' in os.environ)
+_loggers = dict()
+_logobjs = dict()
+_logger_lock = threading.Lock()
+
+def __init_logger(logname):
+    global _hot_logging
+    logger = logging.getLogger(logname)
+    if len(logger.handlers) == 0:
+        loglvl = logging.WARN
+        lvlname = '%s_LOGLEVEL'%(logname.upper())
+        if lvlname in os.environ.keys():
+            v = os.environ[lvlname]
+            vint = 0
+            try:
+                vint = int(v)
+            except:
+                vint = 0
+            if vint >= 4:
+                loglvl = logging.DEBUG
+            elif vint >= 3:
+                loglvl = logging.INFO
+        handler = logging.StreamHandler()
+        fmt = "%(levelname)-8s %(message)s"
+        logfmtname = '%s_LOGFMT'%(logname.upper())
+        if logfmtname in os.environ.keys():
+            v = os.environ[logfmtname]
+            if v is not None and len(v) > 0:
+                fmt = v
+        formatter = logging.Formatter(fmt)
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+        logger.setLevel(loglvl)
+    if logname == 'cmdpack':
+        _hot_logging = logger.isEnabledFor(logging.INFO)
+    return logger
+
+def _get_logger(logname='cmdpack'):
+    logger = _loggers.get(logname,None)
+    if logger is None:
+        with _logger_lock:
+            logger = _loggers.get(logname,None)
+            if logger is None:
+                logger = __init_logger(logname)
+                _loggers[logname] = logger
+    return logger
+
+def _get_logobj(logname='cmdpack'):
+    logobj = _logobjs.get(logname,None)
+    if logobj is None:
+        logobj = _LoggerObject(logname)
+        _logobjs[logname] = logobj
+    return logobj
+
+def configure_logging(level=None,fmt=None,handler=None,logname='cmdpack'):
+    global _hot_logging
+    logger = _get_logger(logname)
+    if handler is not None:
+        for h in list(logger.handlers):
+            logger.removeHandler(h)
+        logger.addHandler(handler)
+    if fmt is not None:
+        for h in logger.handlers:
+            h.setFormatter(logging.Formatter(fmt))
+    if level is not None:
+        logger.setLevel(level)
+    if logname == 'cmdpack':
+        _hot_logging = logger.isEnabledFor(logging.INFO)
+    return logger
+
 class _LoggerObject(object):
     def __init__(self,logname='cmdpack'):
-        self.__logger = logging.getLogger(logname)
-        if len(self.__logger.handlers) == 0:
-            loglvl = logging.WARN
-            lvlname = '%s_LOGLEVEL'%(logname.upper())
-            if lvlname in os.environ.keys():
-                v = os.environ[lvlname]
-                vint = 0
-                try:
-                    vint = int(v)
-                except:
-                    vint = 0
-                if vint >= 4:
-                    loglvl = logging.DEBUG
-                elif vint >= 3:
-                    loglvl = logging.INFO
-            handler = logging.StreamHandler()
-            fmt = "%(levelname)-8s %(message)s"
-            logfmtname = '%s_LOGFMT'%(logname.upper())
-            if logfmtname in os.environ.keys():
-                v = os.environ[logfmtname]
-                if v is not None and len(v) > 0:
-                    fmt = v
-            formatter = logging.Formatter(fmt)
-            handler.setFormatter(formatter)
-            self.__logger.addHandler(handler)
-            self.__logger.setLevel(loglvl)
+        self.__logger = _get_logger(logname)
 
     def format_string(self,arr):
         s = ''
@@ -69,123 +125,437 @@ class _LoggerObject(object):
         inmsg += msg
         return inmsg
 
-    def info(self,msg,callstack=1):
-        inmsg = msg
+    def __log_msg(self,lvl,msg,args,callstack):
+        if len(args) > 0:
+            msg = msg%args
         if callstack is not None:
-            inmsg = self.format_call_msg(msg,(callstack + 1))
-        return self.__logger.info('%s'%(inmsg))
+            msg = self.format_call_msg(msg,(callstack + 2))
+        return self.__logger.log(lvl,'%s'%(msg))
 
-    def error(self,msg,callstack=1):
-        inmsg = msg
-        if callstack is not None:
-            inmsg = self.format_call_msg(msg,(callstack + 1))
-        return self.__logger.error('%s'%(inmsg))
+    def info(self,msg,*args,**kwargs):
+        if not self.__logger.isEnabledFor(logging.INFO):
+            return
+        return self.__log_msg(logging.INFO,msg,args,kwargs.get('callstack',1))
 
-    def warn(self,msg,callstack=1):
-        inmsg = msg
-        if callstack is not None:
-            inmsg = self.format_call_msg(msg,(callstack + 1))
-        return self.__logger.warn('%s'%(inmsg))
+    def error(self,msg,*args,**kwargs):
+        if not self.__logger.isEnabledFor(logging.ERROR):
+            return
+        return self.__log_msg(logging.ERROR,msg,args,kwargs.get('callstack',1))
 
-    def debug(self,msg,callstack=1):
-        inmsg = msg
-        if callstack is not None:
-            inmsg = self.format_call_msg(msg,(callstack + 1))
-        return self.__logger.debug('%s'%(inmsg))
+    def warn(self,msg,*args,**kwargs):
+        if not self.__logger.isEnabledFor(logging.WARNING):
+            return
+        return self.__log_msg(logging.WARNING,msg,args,kwargs.get('callstack',1))
 
-    def fatal(self,msg,callstack=1):
-        inmsg = msg
-        if callstack is not None:
-            inmsg = self.format_call_msg(msg,(callstack + 1))
-        return self.__logger.fatal('%s'%(inmsg))
+    def debug(self,msg,*args,**kwargs):
+        if not self.__logger.isEnabledFor(logging.DEBUG):
+            return
+        return self.__log_msg(logging.DEBUG,msg,args,kwargs.get('callstack',1))
 
+    def fatal(self,msg,*args,**kwargs):
+        if not self.__logger.isEnabledFor(logging.CRITICAL):
+            return
+        return self.__log_msg(logging.CRITICAL,msg,args,kwargs.get('callstack',1))
+
+_shell_quote_expr = re.compile(r'(["`\\])')
+_shell_quote_table = {ord('"'):u'\\"',ord('`'):u'\\`',ord('\\'):u'\\\\'}
+_shell_quote_cache_size = 4096
 
+def __shell_quote_string(s):
+    if sys.platform.lower() == 'win32':
+        # only the last backslash is doubled on win32
+        rets = s.replace('"','\\"')
+        if s.endswith('\\'):
+            rets += '\\'
+        return rets
+    if sys.version[0] == '3' or isinstance(s,unicode):
+        return s.translate(_shell_quote_table)
+    return _shell_quote_expr.sub(r'\\\1',s)
+
+if hasattr(functools,'lru_cache'):
+    _shell_quote_cached = functools.lru_cache(maxsize=_shell_quote_cache_size)(__shell_quote_string)
+else:
+    _shell_quote_cached = __shell_quote_string
 
 def shell_quote_string(s):
-    rets = ''
-    plat = sys.platform.lower()
-    infoobj = _LoggerObject('cmdpack')
-    idx = 0
-    while idx < len(s):
-        c = s[idx]
-        if c == '"':
-            adds = '\\"'
-            infoobj.info('add (%s)'%(adds))
-        elif c == '`':
-            if plat == 'win32':
-                adds = '`'
-            else:
-                adds = '\\`'
-        elif c == '\\':
-            if plat == 'win32':
-                if (idx + 1) == len(s):
-                    adds = '\\\\'
-                else:
-                    adds = '\\'
-            else:
-                adds = '\\\\'
-        else:
-            adds = c
-        rets += adds
-        idx += 1
-    return rets
+    return _shell_quote_cached(s)
 
 def format_list_to_shell_cmd(cmd):
-    rets = ''
+    return ' '.join(['"%s"'%(shell_quote_string(c)) for c in cmd])
+
+_shell_only_cmds = set(['.',':','[[','{','!','alias','bg','break','builtin','case','cd','command',
+    'continue','declare','eval','exec','exit','export','fg','for','function','getopts','hash',
+    'if','jobs','let','local','read','readonly','return','set','shift','source','times','trap',
+    'type','typeset','ulimit','umask','unalias','unset','until','wait','while',
+    # builtins of /bin/sh that are also programs, the program may act not the same
+    '[','echo','false','kill','printf','pwd','test','time','true'])
+_direct_mode = True
+
+def set_direct_mode(mode=True):
+    global _direct_mode
+    _direct_mode = mode
+    return
+
+def __find_exec_file(name,copyenv=None):
+    if os.sep in name:
+        files = [name]
+    else:
+        if copyenv is None:
+            copyenv = os.environ
+        files = []
+        for d in copyenv.get('PATH',os.defpath).split(os.pathsep):
+            if len(d) == 0:
+                d = '.'
+            files.append(os.path.join(d,name))
+    for f in files:
+        if os.path.isfile(f) and os.access(f,os.X_OK):
+            return True
+    return False
+
+def __use_direct_exec(cmd,copyenv=None,directmode=None):
+    if directmode is None:
+        directmode = _direct_mode
+    if not directmode or sys.platform.lower() == 'win32':
+        return False
+    if directmode == 'force':
+        return True
+    if len(cmd) == 0 or cmd[0] in _shell_only_cmds or '=' in cmd[0]:
+        return False
     for c in cmd:
-        if len(rets) > 0:
-            rets += ' '
-        rets += '"%s"'%(shell_quote_string(c))
-    return rets
-
-def run_cmd_wait(cmd,mustsucc=1,noout=1,shellmode=True):
-    p = _LoggerObject('cmdpack')
-    p.debug('run (%s)'%(cmd))
-    cmdin = cmd
-    if isinstance(cmdin,list) and shellmode:
-        cmdin = format_list_to_shell_cmd(cmd)
+        # only $ is expanded inside the double quotes of format_list_to_shell_cmd
+        if '$' in c:
+            return False
+    # not found is exit code 127 from the shell, so keep it
+    return __find_exec_file(cmd[0],copyenv)
+
+def __get_run_cmd(cmd,shellmode,copyenv,directmode,infoobj):
+    if isinstance(cmd,list) and shellmode:
+        if __use_direct_exec(cmd,copyenv,directmode):
+            infoobj.info('direct exec %s',cmd)
+            return cmd,False
+        infoobj.info('shell exec %s',cmd)
+        return format_list_to_shell_cmd(cmd),shellmode
+    return cmd,shellmode
+
+_env_cache = collections.OrderedDict()
+_env_cache_size = 64
+_env_cache_lock = threading.Lock()
+
+def __get_environ_data():
+    # the raw dict behind os.environ, compared without encoding every key again
+    if hasattr(os.environ,'_data'):
+        return os.environ._data
+    if hasattr(os.environ,'data'):
+        return os.environ.data
+    return dict(os.environ)
+
+def __apply_env(env,envoverrides,envremove):
+    if envoverrides is not None:
+        env.update(envoverrides)
+    if envremove is not None:
+        for k in envremove:
+            env.pop(k,None)
+    return env
+
+def __merge_env(copyenv,envoverrides=None,envremove=None):
+    if not envoverrides and not envremove:
+        return copyenv
+    if copyenv is not None:
+        return __apply_env(dict(copyenv),envoverrides,envremove)
+    key = (tuple(sorted(envoverrides.items())) if envoverrides else (),tuple(sorted(envremove)) if envremove else ())
+    curdata = __get_environ_data()
+    with _env_cache_lock:
+        val = _env_cache.pop(key,None)
+        if val is not None and val[0] == curdata:
+            _env_cache[key] = val
+            return val[1]
+    env = __apply_env(os.environ.copy(),envoverrides,envremove)
+    with _env_cache_lock:
+        _env_cache[key] = (dict(curdata),env)
+        while len(_env_cache) > _env_cache_size:
+            _env_cache.popitem(last=False)
+    return env
+
+def __get_exitcode_or_kill(cmdobj,timeout):
+    try:
+        return cmdobj.get_exitcode(timeout=timeout)
+    except CmdTimeoutError:
+        cmdobj.kill()
+        cmdobj.get_exitcode()
+        raise
+
+def run_cmd_wait(cmd,mustsucc=1,noout=1,shellmode=True,directmode=None,env_overrides=None,env_remove=None,tail=None,tail_bytes=None,timeout=None):
+    p = _get_logobj()
+    p.debug('run (%s)',cmd)
+    copyenv = __merge_env(None,env_overrides,env_remove)
+    if tail is not None or tail_bytes is not None or timeout is not None:
+        autoclosefds = []
+        stdoutfile = None
+        stderrfile = None
+        tee = None
+        if (tail is not None or tail_bytes is not None) and noout > 0:
+            # keep the last output of stdout and stderr for the error
+            stdoutfile = subprocess.PIPE
+            stderrfile = subprocess.STDOUT
+        elif tail is not None or tail_bytes is not None:
+            # the output is still shown, only stderr is read to keep its tail
+            stderrfile = subprocess.PIPE
+            try:
+                sys.stderr.flush()
+                tee = sys.stderr.fileno()
+            except:
+                # no fd behind sys.stderr, so keep the tail only
+                tee = None
+        elif noout > 0:
+            stdoutfile = open(os.devnull,'wb')
+            stderrfile = stdoutfile
+            autoclosefds.append(stdoutfile)
+        cmdobj = _CmdRunObject(cmd,stdoutfile,stderrfile,shellmode,copyenv,autoclosefds,directmode=directmode,tail=tail,tail_bytes=tail_bytes,tee=tee)
+        if timeout is None:
+            ret = cmdobj.get_exitcode()
+        else:
+            ret = __get_exitcode_or_kill(cmdobj,timeout)
+        if mustsucc and ret != 0:
+            raise Exception('run cmd (%s) error\n%s'%(cmd,''.join(cmdobj.get_tail())))
+        return ret
+    cmdin,shellin = __get_run_cmd(cmd,shellmode,copyenv,directmode,p)
     if noout > 0:
         devnullfd = open(os.devnull,'wb')
-        ret = subprocess.call(cmdin,stdout=devnullfd,stderr=devnullfd,shell=shellmode)
+        ret = subprocess.call(cmdin,stdout=devnullfd,stderr=devnullfd,shell=shellin,env=copyenv)
         devnullfd.close()
         devnullfd = None
     else:
-        ret = subprocess.call(cmdin,shell=shellmode)
+        ret = subprocess.call(cmdin,shell=shellin,env=copyenv)
     if mustsucc and ret != 0:
         raise Exception('run cmd (%s) error'%(cmd))
     return ret
 
-def run_read_cmd(cmd,stdoutfile=subprocess.PIPE,stderrfile=subprocess.PIPE,shellmode=True,copyenv=None,linebuf=True):
-    infoobj = _LoggerObject('cmdpack')
-    infoobj.info('run %s stdoutfile %s stderrfile %s shellmode %s copyenv %s'%(cmd,stdoutfile,stderrfile,shellmode,copyenv))
-    if copyenv is None:
-        copyenv = os.environ.copy()
-    cmds = cmd
-    if isinstance(cmd,list) and shellmode:
-        cmds = format_list_to_shell_cmd(cmd)
-    infoobj.info('call (%s)'%(cmds))
+class SpawnPopen(_LoggerObject):
+    def __init__(self,args,bufsize=-1,stdout=None,stderr=None,shell=False,env=None,newpgrp=False,stdin=None):
+        super(SpawnPopen,self).__init__('cmdpack')
+        self.args = args
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+        self.returncode = None
+        self.__lock = threading.Lock()
+        if shell:
+            args = ['/bin/sh','-c',args]
+        elif not isinstance(args,list):
+            args = [args]
+        if env is None:
+            env = os.environ
+        if bufsize == 1:
+            # line buffering is not supported in binary mode
+            bufsize = -1
+        closefds = []
+        fileactions = []
+        try:
+            if stdin == subprocess.PIPE:
+                rfd,wfd = os.pipe()
+                closefds.append(rfd)
+                fileactions.append((os.POSIX_SPAWN_DUP2,rfd,0))
+                self.stdin = os.fdopen(wfd,'wb',bufsize)
+            else:
+                self.__get_child_fd(stdin,0,fileactions,closefds)
+            outfd = self.__get_child_fd(stdout,1,fileactions,closefds)
+            if outfd is not None:
+                self.stdout = os.fdopen(outfd,'rb',bufsize)
+            if stderr == subprocess.STDOUT:
+                fileactions.append((os.POSIX_SPAWN_DUP2,1,2))
+            else:
+                errfd = self.__get_child_fd(stderr,2,fileactions,closefds)
+                if errfd is not None:
+                    self.stderr = os.fdopen(errfd,'rb',bufsize)
+            # as close_fds of Popen, after the dup2 so the sources are still there
+            fileactions.extend(self.__get_close_actions())
+            kwargs = dict()
+            if newpgrp:
+                kwargs['setpgroup'] = 0
+            # as restore_signals of Popen, the SIG_IGN of python is not for the child
+            kwargs['setsigdef'] = [getattr(signal,n) for n in ['SIGPIPE','SIGXFSZ'] if hasattr(signal,n)]
+            self.pid = os.posix_spawnp(args[0],args,env,file_actions=fileactions,**kwargs)
+        except:
+            if self.stdin is not None:
+                self.stdin.close()
+                self.stdin = None
+            if self.stdout is not None:
+                self.stdout.close()
+                self.stdout = None
+            if self.stderr is not None:
+                self.stderr.close()
+                self.stderr = None
+            raise
+        finally:
+            for fd in closefds:
+                os.close(fd)
+        self.info('spawn [%s] %s',self.pid,args)
+        return
+
+    def __get_child_fd(self,f,childfd,fileactions,closefds):
+        if f is None:
+            return None
+        if f == subprocess.PIPE:
+            rfd,wfd = os.pipe()
+            closefds.append(wfd)
+            fileactions.append((os.POSIX_SPAWN_DUP2,wfd,childfd))
+            return rfd
+        if f == subprocess.DEVNULL:
+            fd = os.open(os.devnull,os.O_RDWR)
+            closefds.append(fd)
+        elif isinstance(f,int):
+            fd = f
+        else:
+            fd = f.fileno()
+        if fd <= 2:
+            # a copy, so the dup2 before can not change it and our own fd keeps its flags
+            fd = os.dup(fd)
+            closefds.append(fd)
+        fileactions.append((os.POSIX_SPAWN_DUP2,fd,childfd))
+        return None
+
+    def __get_close_actions(self):
+        closeactions = []
+        fddir = '/proc/self/fd'
+        if not os.path.isdir(fddir):
+            fddir = '/dev/fd'
+        try:
+            fds = [int(x) for x in os.listdir(fddir)]
+        except (OSError,ValueError):
+            return closeactions
+        for fd in fds:
+            if fd <= 2:
+                continue
+            try:
+                # the others are closed by exec
+                if os.get_inheritable(fd):
+                    closeactions.append((os.POSIX_SPAWN_CLOSE,fd))
+            except OSError:
+                pass
+        return closeactions
+
+    def __handle_status(self,status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        elif os.WIFEXITED(status):
+            self.returncode = os.WEXITSTATUS(status)
+        return
+
+    def poll(self):
+        if self.returncode is None and self.__lock.acquire(False):
+            try:
+                if self.returncode is None:
+                    pid,status = os.waitpid(self.pid,os.WNOHANG)
+                    if pid == self.pid:
+                        self.__handle_status(status)
+            except ChildProcessError:
+                self.returncode = 0
+            finally:
+                self.__lock.release()
+        return self.returncode
+
+    def wait(self):
+        with self.__lock:
+            while self.returncode is None:
+                try:
+                    pid,status = os.waitpid(self.pid,0)
+                except ChildProcessError:
+                    self.returncode = 0
+                    break
+                if pid == self.pid:
+                    self.__handle_status(status)
+        return self.returncode
+
+    def send_signal(self,sig):
+        if self.poll() is None:
+            try:
+                os.kill(self.pid,sig)
+            except OSError as e:
+                self.info('kill [%s] error [%s]',self.pid,e)
+        return
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+        return
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+        return
+
+_launcher = None
+
+def set_launcher(name=None):
+    global _launcher
+    if name not in [None,'popen','spawn']:
+        raise Exception('unknown launcher [%s]'%(name))
+    _launcher = name
+    return
+
+def __can_spawn(stdoutfile,stderrfile,stdinfile=None):
+    if not hasattr(os,'posix_spawnp') or sys.platform.lower() in ['win32','cygwin']:
+        return False
+    for f in [stdoutfile,stderrfile,stdinfile]:
+        if f is None or isinstance(f,int):
+            continue
+        if not hasattr(f,'fileno'):
+            return False
+    return True
+
+def __get_launcher(name,stdoutfile,stderrfile,stdinfile=None):
+    if name is None:
+        name = _launcher
+    # spawn only when asked for
+    if name is None or name == 'popen':
+        return 'popen'
+    if name != 'spawn':
+        raise Exception('unknown launcher [%s]'%(name))
+    if __can_spawn(stdoutfile,stderrfile,stdinfile):
+        return 'spawn'
+    return 'popen'
+
+def __set_new_pgrp():
+    os.setpgid(0,0)
+    return
+
+def run_read_cmd(cmd,stdoutfile=subprocess.PIPE,stderrfile=subprocess.PIPE,shellmode=True,copyenv=None,linebuf=True,newpgrp=False,directmode=None,launcher=None,env_overrides=None,env_remove=None,stdinfile=None):
+    infoobj = _get_logobj()
+    infoobj.info('run %s stdoutfile %s stderrfile %s shellmode %s copyenv %s',cmd,stdoutfile,stderrfile,shellmode,copyenv)
+    # None inherits os.environ in the child, only build a new one for the overrides
+    copyenv = __merge_env(copyenv,env_overrides,env_remove)
+    cmds,shellmode = __get_run_cmd(cmd,shellmode,copyenv,directmode,infoobj)
+    infoobj.info('call (%s)',cmds)
     if linebuf:
         bufmode = 1
     else:
         bufmode = 0
-    infoobj.info('bufmode %s'%(bufmode))
-    p = subprocess.Popen(cmds,bufsize=bufmode,stdout=stdoutfile,stderr=stderrfile,shell=shellmode,env=copyenv)
+    infoobj.info('bufmode %s',bufmode)
+    if __get_launcher(launcher,stdoutfile,stderrfile,stdinfile) == 'spawn':
+        return SpawnPopen(cmds,bufmode,stdoutfile,stderrfile,shellmode,copyenv,newpgrp,stdinfile)
+    kwargs = dict()
+    if newpgrp and sys.platform.lower() != 'win32':
+        # the child is the leader of a new process group, so the whole tree can get one killpg.
+        # it stays in our session, so it keeps the controlling tty
+        if sys.version_info >= (3,11):
+            kwargs['process_group'] = 0
+        else:
+            kwargs['preexec_fn'] = __set_new_pgrp
+    p = subprocess.Popen(cmds,bufsize=bufmode,stdin=stdinfile,stdout=stdoutfile,stderr=stderrfile,shell=shellmode,env=copyenv,**kwargs)
     return p
 
 def __get_child_pids_win32(pid,recursive=True):
-    infoobj = _LoggerObject('cmdpack')
+    infoobj = _get_logobj()
     pids = []
     cmd = 'wmic process where(ParentProcessId=%d) get ProcessId'%(pid)
-    infoobj.info('run (%s)'%(cmd))
+    infoobj.info('run (%s)',cmd)
     intexpr = re.compile('^([\d]+)\s*$')
     for l in run_cmd_output(cmd):
-        infoobj.info('[%s]'%(l.rstrip('\r\n')))
+        infoobj.info('[%s]',l.rstrip('\r\n'))
         l = l.rstrip('\r\n')
         if intexpr.match(l):
             l = l.strip('\t ')
             l = l.rstrip('\t ')
             cpid = int(l)
-            infoobj.info('[%s] cpid %d'%(l,cpid))
+            infoobj.info('[%s] cpid %d',l,cpid)
             if cpid not in pids:
                 pids.append(cpid)
             if recursive:
@@ -245,7 +615,56 @@ def __get_child_pids_darwin(pid,recursive=True):
                     pids.append(p)
     return pids
 
-def __get_child_pids_linux(pid,recursive=True):
+class ProcTreeSnapshot(object):
+    def __init__(self,procdir='/proc'):
+        self.__procdir = procdir
+        self.__children = dict()
+        if not os.path.isdir(self.__procdir):
+            raise Exception('can not find [%s]'%(self.__procdir))
+        self.refresh()
+        return
+
+    def refresh(self):
+        children = dict()
+        for name in os.listdir(self.__procdir):
+            if not name.isdigit():
+                continue
+            try:
+                with open(os.path.join(self.__procdir,name,'stat'),'rb') as f:
+                    data = f.read()
+            except (IOError,OSError):
+                # process exited when we list
+                continue
+            # comm field may have space or ) in it, so find the last )
+            idx = data.rfind(b')')
+            if idx < 0:
+                continue
+            sarr = data[(idx+1):].split()
+            if len(sarr) < 2:
+                continue
+            ppid = int(sarr[1])
+            if ppid not in children:
+                children[ppid] = []
+            children[ppid].append(int(name))
+        self.__children = children
+        return
+
+    def get_child_pids(self,pid,recursive=True):
+        pids = []
+        visited = set([pid])
+        stack = list(reversed(sorted(self.__children.get(pid,[]))))
+        while len(stack) > 0:
+            cpid = stack.pop()
+            if cpid in visited:
+                continue
+            visited.add(cpid)
+            pids.append(cpid)
+            if recursive:
+                # keep the order of child followed by its descendants
+                stack.extend(reversed(sorted(self.__children.get(cpid,[]))))
+        return pids
+
+def __get_child_pids_linux_ps(pid,recursive=True):
     pids = []
     intexpr = re.compile('([\d]+)')
     for l in run_cmd_output(['ps','-e','-O','ppid']):
@@ -263,14 +682,21 @@ def __get_child_pids_linux(pid,recursive=True):
         if cpid not in pids:
             pids.append(cpid)
         if recursive:
-            cpids = __get_child_pids_linux(cpid,recursive)
+            cpids = __get_child_pids_linux_ps(cpid,recursive)
             for p in cpids:
                 if p not in pids:
                     pids.append(p)
     return pids
 
+def __get_child_pids_linux(pid,recursive=True,snapshot=None):
+    if snapshot is None:
+        if not os.path.isdir('/proc'):
+            return __get_child_pids_linux_ps(pid,recursive)
+        snapshot = ProcTreeSnapshot()
+    return snapshot.get_child_pids(pid,recursive)
 
-def get_child_pids(pid,recursive=True):
+
+def get_child_pids(pid,recursive=True,snapshot=None):
     osname = sys.platform.lower()
     if osname == 'darwin':
         return __get_child_pids_darwin(pid,recursive)
@@ -279,10 +705,436 @@ def get_child_pids(pid,recursive=True):
     elif osname == 'win32':
         return __get_child_pids_win32(pid,recursive)
     elif osname == 'linux2' or osname == 'linux':
-        return __get_child_pids_linux(pid,recursive)
+        return __get_child_pids_linux(pid,recursive,snapshot)
     else:
         raise Exception('not supported platform [%s]'%(osname))
 
+class _CmdStreamDecoder(object):
+    def __init__(self,encoding='UTF-8',errors='strict',fallback='latin-1'):
+        self.__decoder = codecs.getincrementaldecoder(encoding)(errors)
+        self.__encoding = encoding
+        self.__errors = errors
+        self.__fallback = fallback
+        self.__broken = False
+        self.__error = None
+        return
+
+    def pop_error(self):
+        error = self.__error
+        self.__error = None
+        return error
+
+    def decode(self,data,final=False):
+        if self.__broken:
+            # the rest of the stream after a bad byte is dropped
+            return ''
+        try:
+            return self.__decoder.decode(data,final)
+        except UnicodeDecodeError as e:
+            data = self.__decoder.getstate()[0] + data
+            rets = data[:e.start].decode(self.__encoding)
+            if self.__fallback is None:
+                # give what is before the bad byte, the error goes to pop_error
+                self.__broken = True
+                self.__error = e
+                return rets
+            # not the encoding, so use the fallback from the bad byte to the end of the stream
+            self.__decoder = codecs.getincrementaldecoder(self.__fallback)(self.__errors)
+            self.__fallback = None
+            return rets + self.__decoder.decode(data[e.start:],final)
+
+class _CmdReadStream(object):
+    def __init__(self,fd,description,callback,bufsize=65536,sinkfds=[],splice=False):
+        self.fd = fd
+        self.description = description
+        self.__callback = callback
+        self.__bufsize = bufsize
+        self.__sinkfds = sinkfds
+        self.__splice = splice
+        self.paused = False
+        # set by the owner for the selector backend, so resume gives it back to the loop
+        self.loop = None
+        self.__lock = threading.Lock()
+        self.__resumeevt = threading.Event()
+        self.__ended = False
+        self.__dropcallback = None
+        return
+
+    def hold(self):
+        # called by the owner with its lock held, before the read returns paused
+        self.__resumeevt.clear()
+        return
+
+    def resume(self):
+        if self.loop is not None:
+            self.loop.add_streams([self])
+        else:
+            self.__resumeevt.set()
+        return
+
+    def drop(self,callback):
+        # the owner is gone, callback is called once the stream is ended
+        with self.__lock:
+            ended = self.__ended
+            if not ended:
+                self.__dropcallback = callback
+        if ended:
+            callback()
+        return
+
+    def fileno(self):
+        return self.fd
+
+    def __write_sinks(self,data):
+        for fd in list(self.__sinkfds):
+            view = memoryview(data)
+            try:
+                while len(view) > 0:
+                    n = os.write(fd,view)
+                    view = view[n:]
+            except OSError as e:
+                # a broken sink must not stop the reading, so leave it out from now
+                _get_logobj().info('write tee [%d] error [%s]',fd,e)
+                try:
+                    self.__sinkfds.remove(fd)
+                except ValueError:
+                    pass
+        return
+
+    def __splice_read(self):
+        try:
+            n = os.splice(self.fd,self.__sinkfds[0],self.__bufsize)
+        except OSError as e:
+            if e.errno == errno.EINVAL or e.errno == errno.ENOSYS:
+                # the sink can not be spliced into (O_APPEND file and so on)
+                self.__splice = False
+                return self.read()
+            raise
+        return (n > 0)
+
+    def read(self):
+        if self.__splice:
+            return self.__splice_read()
+        try:
+            data = os.read(self.fd,self.__bufsize)
+        except OSError:
+            data = b''
+        if len(data) == 0:
+            return False
+        if len(self.__sinkfds) > 0:
+            self.__write_sinks(data)
+        # the owner asks to stop reading until its buffer drains
+        self.paused = self.__callback(self.description,data)
+        return True
+
+    def close_read(self,error=None):
+        if error is None:
+            self.__callback(self.description,b'')
+        else:
+            self.__callback(self.description,b'',error)
+        with self.__lock:
+            self.__ended = True
+            callback = self.__dropcallback
+            self.__dropcallback = None
+        if callback is not None:
+            callback()
+        return
+
+    def run_thread(self):
+        error = None
+        try:
+            while self.read():
+                if self.paused:
+                    # the owner lets it go on by resume
+                    self.__resumeevt.wait()
+        except Exception as e:
+            # still end the stream, or the owner waits for ever
+            error = e
+        self.close_read(error)
+        return
+
+class _CmdReaderLoop(object):
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__thread = None
+        self.__pending = []
+        self.__wakefds = None
+        return
+
+    def add_streams(self,streams):
+        with self.__lock:
+            self.__pending.extend(streams)
+            if self.__thread is None:
+                self.__wakefds = os.pipe()
+                self.__thread = threading.Thread(target=self.__run_loop,args=(self.__wakefds[0],))
+                self.__thread.daemon = True
+                self.__thread.start()
+            else:
+                os.write(self.__wakefds[1],b'x')
+        return
+
+    def join(self):
+        t = self.__thread
+        if t is not None and t is not threading.current_thread():
+            t.join()
+        return
+
+    def __run_loop(self,wakefd):
+        sel = selectors.DefaultSelector()
+        sel.register(wakefd,selectors.EVENT_READ,None)
+        try:
+            self.__select_streams(sel,wakefd)
+        except Exception as e:
+            # wake all the owners, and let the next add_streams start a new thread
+            streams = [key.data for key in list(sel.get_map().values()) if key.data is not None]
+            with self.__lock:
+                streams.extend(self.__pending)
+                self.__pending = []
+                if self.__wakefds is not None:
+                    os.close(self.__wakefds[0])
+                    os.close(self.__wakefds[1])
+                    self.__wakefds = None
+                self.__thread = None
+            for s in streams:
+                s.close_read(e)
+        sel.close()
+        return
+
+    def __select_streams(self,sel,wakefd):
+        count = 0
+        while True:
+            closed = []
+            with self.__lock:
+                for s in self.__pending:
+                    try:
+                        sel.register(s.fileno(),selectors.EVENT_READ,s)
+                        count += 1
+                    except (ValueError,OSError):
+                        closed.append(s)
+                self.__pending = []
+                if count == 0 and len(closed) == 0:
+                    os.close(self.__wakefds[0])
+                    os.close(self.__wakefds[1])
+                    self.__wakefds = None
+                    self.__thread = None
+                    break
+            for s in closed:
+                s.close_read()
+            if count == 0:
+                continue
+            for key,events in sel.select():
+                if key.data is None:
+                    os.read(wakefd,4096)
+                    continue
+                try:
+                    more = key.data.read()
+                except Exception as e:
+                    sel.unregister(key.fd)
+                    count -= 1
+                    key.data.close_read(e)
+                    continue
+                if not more:
+                    # unregister before signal eof, the owner will close the fd
+                    sel.unregister(key.fd)
+                    count -= 1
+                    key.data.close_read()
+                elif key.data.paused:
+                    # the owner gives it back by add_streams
+                    sel.unregister(key.fd)
+                    count -= 1
+        return
+
+_shared_reader = None
+_shared_reader_lock = threading.Lock()
+_reader_backend = None
+
+def _get_shared_reader():
+    global _shared_reader
+    with _shared_reader_lock:
+        if _shared_reader is None:
+            _shared_reader = _CmdReaderLoop()
+    return _shared_reader
+
+def set_reader_backend(name=None):
+    global _reader_backend
+    if name is not None and name not in ['thread','selector','shared']:
+        raise Exception('unknown reader backend [%s]'%(name))
+    if name in ['selector','shared'] and selectors is None:
+        raise Exception('reader backend [%s] not supported without selectors'%(name))
+    _reader_backend = name
+    return
+
+def _get_reader_backend(name=None):
+    if name is None:
+        name = _reader_backend
+    if name is None:
+        if selectors is not None and sys.platform.lower() != 'win32':
+            name = 'selector'
+        else:
+            name = 'thread'
+    return name
+
+class _CmdReaper(_LoggerObject):
+    def __init__(self,usepidfd=None):
+        super(_CmdReaper,self).__init__('cmdpack')
+        if usepidfd is None:
+            usepidfd = (hasattr(os,'pidfd_open') and selectors is not None)
+        self.__usepidfd = usepidfd
+        # RLock, as add_close may come from a gc run inside our own lock
+        self.__lock = threading.RLock()
+        self.__thread = None
+        self.__wakefds = None
+        self.__pending = []
+        self.__closejobs = dict()
+        return
+
+    def watch(self,p,evt,callback=None):
+        fd = None
+        if self.__usepidfd:
+            try:
+                fd = os.pidfd_open(p.pid)
+            except OSError as e:
+                self.info('pidfd_open [%s] error [%s]',p.pid,e)
+        if fd is None:
+            # no waitpid(-1) here, it would reap the children of others
+            t = threading.Thread(target=self.__wait_child,args=(p,evt,callback))
+            t.daemon = True
+            t.start()
+            return
+        with self.__lock:
+            self.__pending.append((fd,p,evt,callback))
+            if self.__thread is None:
+                self.__wakefds = os.pipe()
+                self.__thread = threading.Thread(target=self.__run_reaper,args=(self.__wakefds[0],))
+                self.__thread.daemon = True
+                self.__thread.start()
+            else:
+                os.write(self.__wakefds[1],b'x')
+        return
+
+    def add_close(self,p,closefiles,evt):
+        with self.__lock:
+            if not evt.is_set():
+                self.__closejobs[id(p)] = (p,closefiles)
+                return
+        self.__close_job(p,closefiles)
+        return
+
+    def __close_job(self,p,closefiles):
+        self.info('reap [%s] exitcode [%s]',p.pid,p.returncode)
+        if p.stdout is not None:
+            p.stdout.close()
+            p.stdout = None
+        if p.stderr is not None:
+            p.stderr.close()
+            p.stderr = None
+        for f in closefiles:
+            if f is not None and hasattr(f,'close'):
+                f.close()
+        return
+
+    def __child_exited(self,p,evt,callback):
+        with self.__lock:
+            evt.set()
+            job = self.__closejobs.pop(id(p),None)
+        if job is not None:
+            self.__close_job(job[0],job[1])
+        if callback is not None:
+            try:
+                callback()
+            except Exception as e:
+                self.info('exit callback [%s] error [%s]',p.pid,e)
+        return
+
+    def __wait_child(self,p,evt,callback):
+        p.wait()
+        self.__child_exited(p,evt,callback)
+        return
+
+    def __run_reaper(self,wakefd):
+        sel = selectors.DefaultSelector()
+        sel.register(wakefd,selectors.EVENT_READ,None)
+        count = 0
+        while True:
+            with self.__lock:
+                for fd,p,evt,callback in self.__pending:
+                    sel.register(fd,selectors.EVENT_READ,(p,evt,callback))
+                    count += 1
+                self.__pending = []
+                if count == 0:
+                    os.close(self.__wakefds[0])
+                    os.close(self.__wakefds[1])
+                    self.__wakefds = None
+                    self.__thread = None
+                    break
+            for key,events in sel.select():
+                if key.data is None:
+                    os.read(wakefd,4096)
+                    continue
+                sel.unregister(key.fd)
+                os.close(key.fd)
+                count -= 1
+                # the child is gone, so this does not block
+                key.data[0].wait()
+                self.__child_exited(key.data[0],key.data[1],key.data[2])
+        sel.close()
+        return
+
+_reaper = None
+_reaper_lock = threading.Lock()
+
+def _get_reaper():
+    global _reaper
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = _CmdReaper()
+    return _reaper
+
+def _reap_later(p,closefiles,evt,cond=None,streams=[],paused=[]):
+    # called by weakref.finalize in whatever thread runs the gc, so never block here
+    if len(streams) == 0:
+        _get_reaper().add_close(p,closefiles,evt)
+        return
+    left = [len(streams)]
+    lock = threading.Lock()
+    def stream_ended():
+        with lock:
+            left[0] -= 1
+            done = (left[0] == 0)
+        if done:
+            # the streams are done with the fds, so the reaper may close them
+            _get_reaper().add_close(p,closefiles,evt)
+        return
+    with cond:
+        resumes = list(paused)
+        del paused[:]
+    for st in streams:
+        st.drop(stream_ended)
+    # nobody takes the lines, so the paused streams read the rest into nothing
+    for st in resumes:
+        st.resume()
+    return
+
+_monotonic = getattr(time,'monotonic',time.time)
+
+class CmdStreamItem(object):
+    __slots__ = ['stream','data','ts']
+
+    def __init__(self,stream,data,ts=None):
+        self.stream = stream
+        self.data = data
+        self.ts = ts
+        return
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return 'CmdStreamItem(%r,%r,%r)'%(self.stream,self.data,self.ts)
+
+class CmdTimeoutError(Exception):
+    pass
+
 class CmdObjectAttr(object):
     def __init__(self):
         pass
@@ -299,66 +1151,329 @@ class CmdObjectAttr(object):
 
 
 class _CmdRunObject(_LoggerObject):
-    def __trans_to_string(self,s):
-        if sys.version[0] == '3':
-            encodetype = ['UTF-8','latin-1']
-            idx=0
-            while idx < len(encodetype):
-                try:
-                    return s.decode(encoding=encodetype[idx])
-                except:
-                    idx += 1
-            raise Exception('not valid bytes (%s)'%(repr(s)))
-        return s
+    def __get_decoder(self,description):
+        if self.__binary:
+            return None
+        if self.__encoding is None and sys.version[0] != '3':
+            return None
+        encoding = self.__encoding
+        fallback = None
+        if encoding is None:
+            encoding = 'UTF-8'
+            if self.__errors == 'strict':
+                fallback = 'latin-1'
+        return _CmdStreamDecoder(encoding,self.__errors,fallback)
+
+    def __split_chunk(self,data):
+        rlines = []
+        if self.__chunksize is None or self.__chunksize <= 0:
+            if len(data) > 0:
+                rlines.append(data)
+            return rlines
+        idx = 0
+        while idx < len(data):
+            rlines.append(data[idx:(idx+self.__chunksize)])
+            idx += self.__chunksize
+        return rlines
+
+    def __split_lines(self,description,data,final):
+        rlines = []
+        leftover = self.__partial.pop(description,None)
+        if leftover is not None:
+            data = leftover + data
+        nl = '\n'
+        if not isinstance(data,type(nl)):
+            nl = b'\n'
+        parts = data.split(nl)
+        last = parts.pop()
+        for l in parts:
+            rlines.append(l + nl)
+        if len(last) > 0:
+            if final:
+                rlines.append(last)
+            else:
+                self.__partial[description] = last
+        return rlines
+
+    def __filter_lines(self,rlines,sizes):
+        if self.__forward is None:
+            return rlines,sizes
+        flines = []
+        fsizes = []
+        for l,n in zip(rlines,sizes):
+            if isinstance(self.__forward,int):
+                keep = ((self.__forwardcnt % self.__forward) == 0)
+                self.__forwardcnt += 1
+            else:
+                keep = self.__forward.search(l)
+            if keep:
+                flines.append(l)
+                fsizes.append(n)
+        return flines,fsizes
+
+    def __line_sizes(self,description,rlines,nraw):
+        # the bytes read are given to the lines made of them, so max_buffered_bytes
+        # counts the bytes of the pipe and not the decoded chars
+        left = self.__rawleft[description] + nraw
+        if len(rlines) == 0:
+            self.__rawleft[description] = left
+            return []
+        sizes = []
+        for l in rlines[:-1]:
+            n = min(len(l),left)
+            sizes.append(n)
+            left -= n
+        sizes.append(left)
+        self.__rawleft[description] = 0
+        return sizes
 
-    def __enqueue_output(self,out, queue,description,endq,linebuf):
-        if linebuf:
-            for line in iter(out.readline, b''):
-                transline = self.__trans_to_string(line)
-                queue.put(transline)
+    def __feed_data(self,description,data,error=None):
+        final = (len(data) == 0)
+        rlines = []
+        sizes = []
+        if error is not None:
+            # the reader of this stream is gone, end it and keep the error for the consumer
+            self.info('read [%s] error [%s]',description,error)
+            with self.__cond:
+                if self.__readerror is None:
+                    self.__readerror = error
+            # nobody reads the pipe any more, so the child gets EPIPE instead of blocking on it
+            self.__close_pipe(description)
+        elif self.__forward == 'none' and not final:
+            return False
         else:
-            while True:
-                line = out.read(1)
-                self.info('read no line feed [%s][%s]'%(description,line))
-                if line is None or len(line) == 0:
-                    break
-                transline = self.__trans_to_string(line)
-                queue.put(transline)
-        endq.put('done')
-        endq.task_done()
+            rlines,sizes = self.__decode_lines(description,data,final)
+        return self.__feed_lines(description,rlines,final,sizes)
+
+    def __close_pipe(self,description):
+        if description == 'stdout':
+            if self.__p.stdout is not None:
+                self.__p.stdout.close()
+                self.__p.stdout = None
+        elif self.__p.stderr is not None:
+            self.__p.stderr.close()
+            self.__p.stderr = None
+        return
+
+    def __decode_lines(self,description,data,final):
+        nraw = len(data)
+        decoder = self.__decoders.get(description,None)
+        if decoder is not None:
+            data = decoder.decode(data,final)
+            error = decoder.pop_error()
+            if error is not None:
+                # keep reading the pipe, the error goes to the consumer at eof
+                self.info('decode [%s] error [%s]',description,error)
+                with self.__cond:
+                    if self.__readerror is None:
+                        self.__readerror = error
+        if self.__linebuf:
+            rlines = self.__split_lines(description,data,final)
+        else:
+            if _hot_logging:
+                self.info('read no line feed [%s][%s]',description,data)
+            rlines = self.__split_chunk(data)
+        sizes = self.__line_sizes(description,rlines,nraw)
+        if self.__forward is not None and self.__forward != 'none':
+            rlines,sizes = self.__filter_lines(rlines,sizes)
+        return rlines,sizes
+
+    def __feed_lines(self,description,rlines,final,sizes):
+        nbytes = 0
+        if self.__tail is None and len(rlines) > 0:
+            nbytes = sum(sizes)
+            if self.__tagitems:
+                ts = None
+                if self.__timestamps:
+                    ts = _monotonic()
+                rlines = [CmdStreamItem(description,l,ts) for l in rlines]
+        endcallbacks = []
+        pause = False
+        with self.__cond:
+            if self.__tail is not None:
+                self.__add_tail(rlines)
+                rlines = []
+            self.recvq.extend(rlines)
+            if len(rlines) > 0:
+                self.__recvsizes.extend(sizes)
+                self.__bufbytes[description] += nbytes
+                self.__buflines[description] += len(rlines)
+                totalbytes = self.__bufbytes['stdout'] + self.__bufbytes['stderr']
+                if totalbytes > self.highwaterbytes:
+                    self.highwaterbytes = totalbytes
+                if len(self.recvq) > self.highwaterlines:
+                    self.highwaterlines = len(self.recvq)
+            if final:
+                if description == 'stdout':
+                    self.__outeof = True
+                else:
+                    self.__erreof = True
+                endcallbacks = self.__take_end_callbacks()
+            self.__cond.notify_all()
+            if not final and self.__over_limit(description):
+                # stop reading till resume, so the child blocks on the full pipe
+                for st in self.__streams:
+                    if st.description == description:
+                        st.hold()
+                        self.__paused.append(st)
+                pause = True
+        for callback,ctx in endcallbacks:
+            callback(self,ctx)
+        return pause
+
+    def __add_tail(self,rlines):
+        # must be called with __cond held
+        q = self.__tail
+        if self.__tailbytes is None:
+            q.extend(rlines)
+            return
+        for l in rlines:
+            if q.maxlen is not None and len(q) == q.maxlen:
+                self.__tailsize -= q[0][1]
+            size = len(self.__encode_tail(l))
+            q.append((l,size))
+            self.__tailsize += size
+            # keep the first line that is partly in tail_bytes
+            while len(q) > 0 and (self.__tailsize - q[0][1]) >= self.__tailbytes:
+                self.__tailsize -= q.popleft()[1]
+        return
+
+    def __encode_tail(self,l):
+        # tail_bytes counts the bytes of the output, not the decoded chars
+        if isinstance(l,bytes):
+            return l
+        encoding = self.__encoding
+        if encoding is None:
+            encoding = 'UTF-8'
+        return l.encode(encoding,'replace')
+
+    def get_tail(self):
+        with self.__cond:
+            if self.__tail is None:
+                return []
+            rlines = list(self.__tail)
+            if self.__tailbytes is not None:
+                rlines = [l for l,_ in rlines]
+            if self.__tailbytes is not None and self.__tailsize > self.__tailbytes:
+                # only the end of the first line fits in
+                cutsize = self.__tailsize - self.__tailbytes
+                if isinstance(rlines[0],bytes):
+                    rlines[0] = rlines[0][cutsize:]
+                else:
+                    encoding = self.__encoding
+                    if encoding is None:
+                        encoding = 'UTF-8'
+                    rlines[0] = self.__encode_tail(rlines[0])[cutsize:].decode(encoding,'ignore')
+        return rlines
+
+    def __over_limit(self,description):
+        # must be called with __cond held, each stream is counted alone,
+        # so the lines left for another reader do not stop this one
+        if self.__unbounded or self.recvq is None:
+            return False
+        if self.__maxlines is not None and self.__buflines[description] >= self.__maxlines:
+            return True
+        if self.__maxbytes is not None and self.__bufbytes[description] >= self.__maxbytes:
+            return True
+        return False
+
+    def __resume_streams(self):
+        # must be called with __cond held
+        if self.__maxlines is None and self.__maxbytes is None:
+            return
+        resumes = [st for st in self.__paused if not self.__over_limit(st.description)]
+        for st in resumes:
+            # in place, the finalizer holds the same list
+            self.__paused.remove(st)
+            st.resume()
+        return
+
+    def __take_item(self,item,size):
+        # must be called with __cond held
+        if self.__tagitems:
+            description = item.stream
+        else:
+            description = self.__onlystream
+        self.__bufbytes[description] -= size
+        self.__buflines[description] -= 1
+        return
+
+    def __lift_limit(self):
+        with self.__cond:
+            self.__unbounded = True
+            self.__resume_streams()
+        return
+
+    def __take_end_callbacks(self):
+        # must be called with __cond held, the callbacks run when the output is all read and the child exited
+        if not self.__outeof or not self.__erreof or not self.__exitevt.is_set():
+            return []
+        endcallbacks = self.__endcallbacks
+        self.__endcallbacks = []
+        return endcallbacks
+
+    def __child_exited(self):
+        # called in the reaper thread after __exitevt is set
+        with self.__cond:
+            endcallbacks = self.__take_end_callbacks()
+            self.__cond.notify_all()
+        for callback,ctx in endcallbacks:
+            callback(self,ctx)
+        return
+
+    def add_end_callback(self,callback,ctx):
+        with self.__cond:
+            if not self.__outeof or not self.__erreof or not self.__exitevt.is_set():
+                self.__endcallbacks.append((callback,ctx))
+                return
+        callback(self,ctx)
         return
+
     def __prepare_out(self):
         if self.__p.stdout is not None:
             if self.recvq is None:
-                self.recvq = Queue.Queue()
-            assert(self.endout is None)
-            self.endout = Queue.Queue()
-            assert(self.tout is None)
-            self.tout = threading.Thread(target=self.__enqueue_output,args=(self.__p.stdout,self.recvq,'stdout',self.endout,self.__linebuf))
+                self.recvq = collections.deque()
+            self.__outeof = False
+            self.__decoders['stdout'] = self.__get_decoder('stdout')
+            self.__streams.append(_CmdReadStream(self.__p.stdout.fileno(),'stdout',self.__feedcallback,self.__bufsize,self.__sinkfds,self.__splice))
         return
 
     def __prepare_err(self):
         if self.__p.stderr is not None:
             if self.recvq is None:
-                self.recvq = Queue.Queue()
-            assert(self.enderr is None)
-            self.enderr = Queue.Queue()
-            assert(self.terr is None)
-            self.terr = threading.Thread(target=self.__enqueue_output,args=(self.__p.stderr,self.recvq,'stderr',self.enderr,self.__linebuf))
+                self.recvq = collections.deque()
+            self.__erreof = False
+            self.__decoders['stderr'] = self.__get_decoder('stderr')
+            self.__streams.append(_CmdReadStream(self.__p.stderr.fileno(),'stderr',self.__feedcallback,self.__bufsize,self.__sinkfds,self.__splice))
         return
 
-    def __start_out(self):
-        if self.tout is not None:
-            self.tout.start()
-            self.outended = False
-            self.info('outended False')
-        return
-
-    def __start_err(self):
-        if self.terr is not None:
-            self.terr.start()
-            self.errended = False
-            self.info('errended False')
+    def __start_reader(self):
+        for st in self.__streams:
+            if st.description == 'stdout':
+                self.outended = False
+                self.info('outended False')
+            else:
+                self.errended = False
+                self.info('errended False')
+        if len(self.__streams) == 0:
+            return
+        self.info('reader backend [%s]',self.__reader)
+        if self.__reader == 'thread':
+            for st in self.__streams:
+                t = threading.Thread(target=st.run_thread)
+                if st.description == 'stdout':
+                    self.tout = t
+                else:
+                    self.terr = t
+                t.start()
+        else:
+            if self.__reader == 'shared':
+                self.__loop = _get_shared_reader()
+            else:
+                self.__loop = _CmdReaderLoop()
+            for st in self.__streams:
+                st.loop = self.__loop
+            self.__loop.add_streams(self.__streams)
         return
 
     def __auto_close(self,f):
@@ -367,81 +1482,267 @@ class _CmdRunObject(_LoggerObject):
             f = None
         return
 
-    def __init__(self,cmd,stdoutfile,stderrfile,shellmode,copyenv,autoclosefds=[],linebuf=True):
+    def __prepare_tee(self,tee,forward):
+        self.__sinkfds = []
+        if tee is not None:
+            if not isinstance(tee,list):
+                tee = [tee]
+            for t in tee:
+                if isinstance(t,str) or (sys.version[0] == '2' and isinstance(t,unicode)):
+                    t = open(t,'wb')
+                    self.__closefiles.append(t)
+                if isinstance(t,int):
+                    self.__sinkfds.append(t)
+                else:
+                    self.__sinkfds.append(t.fileno())
+        self.__forwardcnt = 0
+        if forward is None or forward == 'all':
+            self.__forward = None
+        elif forward == 'none':
+            self.__forward = forward
+        elif isinstance(forward,int):
+            if forward < 1:
+                raise Exception('forward [%d] must be 1 or more'%(forward))
+            self.__forward = forward
+        elif hasattr(forward,'search'):
+            self.__forward = forward
+        else:
+            self.__forward = re.compile(forward)
+        # one sink and nothing for us, so let the kernel move the data
+        self.__splice = (len(self.__sinkfds) == 1 and self.__forward == 'none' and hasattr(os,'splice'))
+        return
+
+    def __init__(self,cmd,stdoutfile,stderrfile,shellmode,copyenv,autoclosefds=[],linebuf=True,reader=None,chunksize=1,encoding=None,errors='strict',binary=False,newpgrp=False,directmode=None,launcher=None,env_overrides=None,env_remove=None,max_buffered_bytes=None,max_buffered_lines=None,tail=None,tail_bytes=None,tee=None,forward=None,tagged=False,timestamps=False,stdinfile=None,peers=None):
         super(_CmdRunObject,self).__init__('cmdpack')
-        self.__p = run_read_cmd(cmd,stdoutfile,stderrfile,shellmode,copyenv,linebuf)
-        self.__closefiles=autoclosefds
+        self.__newpgrp = newpgrp
+        # the (p,evt) of the stages before us in a pipeline, watched by the reaper
+        self.__peers = []
+        if peers is not None:
+            self.__peers = list(peers)
+        self.__peercodes = []
+        # the childs of our child and of the peers, seen before they are reaped
+        self.__seenpids = dict()
+        # ready before the child starts, the reaper may call back at once
+        self.__cond = threading.Condition()
+        self.__endcallbacks = []
+        self.__outeof = True
+        self.__erreof = True
+        # set by the reaper as soon as the child exits
+        self.__exitevt = threading.Event()
+        self.__closefiles = list(autoclosefds)
+        try:
+            # a bad tee or forward must fail before the child starts
+            self.__prepare_tee(tee,forward)
+            self.__p = run_read_cmd(cmd,stdoutfile,stderrfile,shellmode,copyenv,linebuf,newpgrp,directmode,launcher,env_overrides,env_remove,stdinfile)
+        except:
+            for f in self.__closefiles:
+                f.close()
+            raise
+        # a weak ref, so a dropped object is still collected while its child runs
+        selfref = weakref.ref(self)
+        def child_exited():
+            obj = selfref()
+            if obj is not None:
+                obj.__child_exited()
+            return
+        def feed_data(description,data,error=None):
+            obj = selfref()
+            if obj is None:
+                # dropped, the rest of the output goes nowhere
+                return False
+            return obj.__feed_data(description,data,error)
+        self.__feedcallback = feed_data
+        # the streams and the paused of them are given to the finalizer
+        self.__streams = []
+        self.__paused = []
+        _get_reaper().watch(self.__p,self.__exitevt,child_exited)
+        self.__finalizer = None
+        if hasattr(weakref,'finalize'):
+            # the objects dropped without get_exitcode are reaped in background
+            self.__finalizer = weakref.finalize(self,_reap_later,self.__p,self.__closefiles,self.__exitevt,self.__cond,self.__streams,self.__paused)
+            self.__finalizer.atexit = False
         self.terr = None
         self.tout = None
-        self.endout = None
         self.outended = True
         self.errended = True
         self.recvq = None
-        self.enderr = None
-        self.endout = None
+        self.__readerror = None
         self.__linebuf= linebuf
+        self.__reader = _get_reader_backend(reader)
+        self.__loop = None
+        self.__partial = dict()
+        self.__decoders = dict()
+        self.__encoding = encoding
+        self.__errors = errors
+        self.__binary = binary
+        self.__chunksize = chunksize
+        self.__maxbytes = max_buffered_bytes
+        self.__maxlines = max_buffered_lines
+        self.__bufbytes = dict(stdout=0,stderr=0)
+        self.__buflines = dict(stdout=0,stderr=0)
+        # the bytes of each line in recvq, and the bytes read and not yet in a line
+        self.__recvsizes = collections.deque()
+        self.__rawleft = dict(stdout=0,stderr=0)
+        self.__unbounded = False
+        self.highwaterbytes = 0
+        self.highwaterlines = 0
+        self.__tail = None
+        self.__tailbytes = tail_bytes
+        self.__tailsize = 0
+        if tail is not None or tail_bytes is not None:
+            self.__tail = collections.deque(maxlen=tail)
+        self.__bufsize = 65536
+        if chunksize is not None and chunksize > self.__bufsize:
+            self.__bufsize = chunksize
         self.__prepare_out()
         self.__prepare_err()
-        self.__start_out()
-        self.__start_err()
+        self.__tagged = tagged
+        self.__timestamps = timestamps
+        # with one pipe every item is of its stream, so no need to tag
+        self.__tagitems = (tagged or timestamps or len(self.__streams) > 1)
+        self.__onlystream = None
+        if len(self.__streams) == 1:
+            self.__onlystream = self.__streams[0].description
+        self.__start_reader()
         self.__retcode = 0
         return
 
-    def __wait_err(self):
+    def __wait_readers(self):
+        if self.tout is not None:
+            self.tout.join()
+            self.tout = None
         if self.terr is not None:
             self.terr.join()
             self.terr = None
+        with self.__cond:
+            while not self.__outeof or not self.__erreof:
+                self.__cond.wait()
+        if self.__loop is not None:
+            if self.__reader != 'shared':
+                self.__loop.join()
+            self.__loop = None
         return
 
-    def __wait_out(self):
-        if self.tout is not None:
-            self.tout.join()
-            self.tout = None
-
     def __wait_recvq(self):
-        if self.recvq is not None:
-            while not self.recvq.empty():
-                try:
-                    rl = self.recvq.get_nowait()
-                    self.info('get [%s]'%(rl))
-                except Queue.Empty:
-                    pass
-            # nothing to be done
-            self.recvq = None
+        with self.__cond:
+            if self.recvq is not None:
+                self.info('drop [%d] lines',len(self.recvq))
+                # nothing to be done
+                self.recvq = None
+                self.__recvsizes = collections.deque()
         return
 
-    def __get_exitcode(self):
-        exitcode = self.__retcode
-        if self.__p is not None:
-            while True:
-                # wait 
-                pret = self.__p.poll()
-                if pret is not None:
-                    exitcode = pret
-                    self.info('exitcode %d'%(exitcode))
+    def __check_ended(self):
+        # must be called with __cond held
+        if not self.outended and self.__outeof:
+            self.info('outended')
+            self.outended = True
+        if not self.errended and self.__erreof:
+            self.info('errended')
+            self.errended = True
+        return
+
+    def __give_items(self,retlines,items):
+        if self.__tagitems and not self.__tagged:
+            retlines.extend([i.data for i in items])
+        else:
+            retlines.extend(items)
+        return
+
+    def __pop_stream_lines(self,retlines,maxlines,streams):
+        # must be called with __cond held, the other streams stay for their readers
+        q = self.recvq
+        items = []
+        keep = collections.deque()
+        keepsizes = collections.deque()
+        for item,size in zip(q,self.__recvsizes):
+            if item.stream in streams and (maxlines is None or (len(retlines) + len(items)) < maxlines):
+                items.append(item)
+                self.__take_item(item,size)
+            else:
+                keep.append(item)
+                keepsizes.append(size)
+        if len(items) == 0:
+            return False
+        self.recvq = keep
+        self.__recvsizes = keepsizes
+        self.__give_items(retlines,items)
+        self.__resume_streams()
+        return True
+
+    def __pop_lines(self,retlines,maxlines=None,streams=None):
+        # must be called with __cond held
+        q = self.recvq
+        if q is None or len(q) == 0:
+            return False
+        if streams is not None:
+            if self.__tagitems:
+                return self.__pop_stream_lines(retlines,maxlines,streams)
+            if self.__onlystream not in streams:
+                return False
+        cnt = len(q)
+        if maxlines is not None and (maxlines - len(retlines)) < cnt:
+            cnt = maxlines - len(retlines)
+        if cnt == len(q):
+            # take the whole buffer at once
+            self.recvq = collections.deque()
+            self.__give_items(retlines,q)
+            self.__bufbytes = dict(stdout=0,stderr=0)
+            self.__buflines = dict(stdout=0,stderr=0)
+            self.__recvsizes = collections.deque()
+        else:
+            items = []
+            while cnt > 0:
+                l = q.popleft()
+                self.__take_item(l,self.__recvsizes.popleft())
+                items.append(l)
+                cnt -= 1
+            self.__give_items(retlines,items)
+        self.__resume_streams()
+        return True
+
+    def __streams_ended(self,streams=None):
+        # must be called with __cond held
+        if streams is None:
+            return self.errended and self.outended
+        if 'stdout' in streams and not self.outended:
+            return False
+        if 'stderr' in streams and not self.errended:
+            return False
+        return True
+
+    def __wait_lines(self,etime=None,minlines=1,maxlines=None,streams=None):
+        retlines = []
+        with self.__cond:
+            while len(retlines) < minlines:
+                if self.__pop_lines(retlines,maxlines,streams):
+                    continue
+                self.__check_ended()
+                if self.__streams_ended(streams):
                     break
-                # wait for a time
-                self.info('will wait')
-                time.sleep(0.1)
-            while (not self.errended) or (not self.outended):
-                if not self.errended:
-                    try:
-                        rl = self.enderr.get_nowait()
-                        if rl == 'done':
-                            self.errended = True
-                            self.enderr.join()
-                            self.enderr = None
-                    except Queue.Empty:
-                        pass
-                if not self.outended:
-                    try:
-                        rl = self.endout.get_nowait()
-                        if rl == 'done':
-                            self.outended = True
-                            self.endout.join()
-                            self.endout = None
-                    except Queue.Empty:
-                        pass
+                if etime is None:
+                    self.__cond.wait()
+                else:
+                    ctime = time.time()
+                    if ctime >= etime:
+                        break
+                    self.__cond.wait(etime - ctime)
+        return retlines
+
+    def __get_exitcode(self):
+        exitcode = self.__retcode
+        if self.__p is not None:
+            self.__lift_limit()
+            # let the reaper take the status, so no two waitpid at once
+            self.__exitevt.wait()
+            exitcode = self.__p.wait()
+            self.info('exitcode %d',exitcode)
+            self.__wait_peers()
+            self.__peercodes = [p.wait() for p,evt in self.__peers]
+            with self.__cond:
+                while not self.__outeof or not self.__erreof:
+                    self.__cond.wait()
+                self.__check_ended()
             if self.__p.stdout is not None:
                 self.__p.stdout.close()
                 self.__p.stdout = None
@@ -452,286 +1753,666 @@ class _CmdRunObject(_LoggerObject):
         for f in self.__closefiles:
             self.__auto_close(f)
         self.__closefiles = []
-        self.info('exitcode (%s)'%(exitcode))
+        if self.__finalizer is not None:
+            # all is cleaned, nothing left for the reaper
+            self.__finalizer.detach()
+            self.__finalizer = None
+        self.info('exitcode (%s)',exitcode)
         self.__retcode = exitcode
         return exitcode
 
-    def call_readback(self,callback,ctx):
+    def call_readback(self,callback,ctx,etime=None):
         if self.__p is None:
             return
         while True:
-            if self.errended and self.outended:
+            rlines = self.__wait_lines(etime,1)
+            if len(rlines) == 0:
                 self.info('outended errended')
                 break
-            try:
-                rl = self.recvq.get_nowait()
-                if callback is not None:
+            if callback is not None:
+                for rl in rlines:
                     callback(rl,ctx)
-            except Queue.Empty:
-                if not self.errended:
-                    try:
-                        rl = self.enderr.get_nowait()
-                        if rl == 'done':
-                            self.info('errended')
-                            self.errended = True
-                            self.enderr.join()
-                            self.enderr = None
-                    except Queue.Empty:
-                        pass
-                if not self.outended :
-                    try:
-                        rl = self.endout.get_nowait()
-                        if rl == 'done':
-                            self.info('outended')
-                            self.outended = True
-                            self.endout.join()
-                            self.endout = None
-                    except Queue.Empty:
-                        pass
-                if not self.errended or not self.outended:
-                    # sleep for a while to get 
-                    time.sleep(0.1)
+        self.__raise_read_error()
         return
 
-    def __iter__(self):
+    def __raise_read_error(self,streams=None):
+        with self.__cond:
+            error = self.__readerror
+            self.__check_ended()
+            if error is None or not self.__streams_ended(streams):
+                return
+            # only once, so get_exitcode still works after
+            self.__readerror = None
+        raise error
+
+    def iter_lines(self,streams=None):
         if self.__p is not None:
             while True:
-                if self.errended and self.outended:
+                rlines = self.__wait_lines(None,1,None,streams)
+                if len(rlines) == 0:
                     break
-                try:
-                    rl = self.recvq.get_nowait()
+                for rl in rlines:
                     yield rl
-                except Queue.Empty:
-                    if not self.errended:
-                        try:
-                            rl = self.enderr.get_nowait()
-                            if rl == 'done':
-                                self.errended = True
-                                self.enderr.join()
-                                self.enderr = None
-                        except Queue.Empty:
-                            pass
-                    if not self.outended :
-                        try:
-                            rl = self.endout.get_nowait()
-                            if rl == 'done':
-                                self.outended = True
-                                self.endout.join()
-                                self.endout = None
-                        except Queue.Empty:
-                            pass
-                    if not self.errended or not self.outended:
-                        # sleep for a while to get 
-                        time.sleep(0.1)
-            # all is ok ,so remove the resource
-            self.__clean_resource()
+            # the lines of the other streams may still be wanted
+            if streams is None:
+                # all is ok ,so remove the resource
+                self.__clean_resource()
+            self.__raise_read_error(streams)
 
-    def get_lines(self,timeout=1.0,minlines=1):
+    def __iter__(self):
+        return self.iter_lines()
+
+    def get_lines(self,timeout=1.0,minlines=1,maxlines=None,streams=None):
         retlines = []
         stime = time.time()
         etime = stime + timeout
+        if maxlines is None or maxlines < minlines:
+            maxlines = minlines
         if self.__p is not None:
-            while len(retlines) < minlines:
-                ctime = time.time()
-                if ctime > etime:
-                    break
-                if self.errended and self.outended:
-                    break
-                try:
-                    rl = self.recvq.get_nowait()
-                    retlines.append(rl)
-                except Queue.Empty:
-                    if not self.errended:
-                        try:
-                            rl = self.enderr.get_nowait()
-                            if rl == 'done':
-                                self.errended = True
-                                self.enderr.join()
-                                self.enderr = None
-                        except Queue.Empty:
-                            pass
-                    if not self.outended :
-                        try:
-                            rl = self.endout.get_nowait()
-                            if rl == 'done':
-                                self.outended = True
-                                self.endout.join()
-                                self.endout = None
-                        except Queue.Empty:
-                            pass
-                    if not self.errended or not self.outended:
-                        # sleep for a while to get 
-                        time.sleep(0.1)
+            retlines = self.__wait_lines(etime,minlines,maxlines,streams)
         else:
-            notempty = True
-            while len(retlines) < minlines and notempty:
-                try:
-                    if self.recvq is not None:
-                        rl = self.recvq.get_nowait()
-                        retlines.append(rl)
-                    else:
-                        notempty = False
-                except Queue.Empty:
-                    notempty = False
-                    if not self.outended:
-                        try:
-                            rl = self.endout.get_nowait()
-                            if rl == 'done':
-                                self.outended = True
-                                self.endout.join()
-                                self.endout = None
-                        except Queue.Empty:
-                            pass
-                    if not self.errended:
-                        try:
-                            rl = self.enderr.get_nowait()
-                            if rl == 'done':
-                                self.errended = True
-                                self.enderr.join()
-                                self.enderr = None
-                        except Queue.Empty:
-                            pass
+            with self.__cond:
+                if not self.__pop_lines(retlines,maxlines,streams):
+                    self.__check_ended()
+        if len(retlines) == 0:
+            self.__raise_read_error(streams)
         return retlines
 
 
 
     def __clean_resource(self):
         while True:
-            rlines = self.get_lines(0.1,100)
+            rlines = self.__wait_lines(time.time() + 0.1,100,100)
             if len(rlines) == 0:
                 break
-        self.__wait_out()
-        self.__wait_err()
+        self.__wait_readers()
         self.__wait_recvq()
         return self.__get_exitcode()
 
-    def __send_kill(self,pid):
+    def __send_kill(self,pid,sig=None):
         osname = sys.platform.lower()
-        self.info('send kill [%s]'%(pid))
+        self.info('send kill [%s] sig [%s]',pid,sig)
         if osname == 'win32':
             cmd = 'taskkill /F /PID %d'%(pid)
-            self.info('call [%s]'%(cmd))
+            self.info('call [%s]',cmd)
             devnullfd=open(os.devnull,'wb')
             subprocess.call(cmd,stdout=devnullfd,stderr=devnullfd,shell=True) 
             devnullfd.close()
             devnullfd = None
         elif osname == 'cygwin' or osname == 'linux' or osname == 'linux2' or osname == 'darwin':
-            cmd='kill -9 %d'%(pid)
-            devnullfd=open(os.devnull,'wb')
-            subprocess.call(cmd,stdout=devnullfd,stderr=devnullfd,shell=True)
-            devnullfd.close()
-            devnullfd = None
+            if sig is None:
+                sig = signal.SIGKILL
+            try:
+                os.kill(pid,sig)
+            except OSError as e:
+                # already exited
+                self.info('kill [%s] error [%s]',pid,e)
         else:
             raise Exception('unsupported osname [%s]'%(osname))
         return
 
-    def __kill_proc_childs(self,pid):
-        cpids = get_child_pids(pid)
-        self.__send_kill(pid)
-        for p in cpids:            
-            self.__send_kill(p)
+    def __see_childs(self,pid,exitevt):
+        # the childs are given to init when the child exits, so keep them while it runs
+        if not self.__newpgrp and not exitevt.is_set():
+            self.__seenpids[pid] = get_child_pids(pid)
+        return self.__seenpids.get(pid,[])
+
+    def __kill_proc_childs(self,pid,exitevt,sig=None):
+        if self.__newpgrp and sys.platform.lower() != 'win32':
+            if sig is None:
+                sig = signal.SIGKILL
+            # the group id is not reused while any of the group still runs
+            self.info('killpg [%s] sig [%s]',pid,sig)
+            try:
+                os.killpg(pid,sig)
+            except OSError as e:
+                self.info('killpg [%s] error [%s]',pid,e)
+            return
+        cpids = self.__see_childs(pid,exitevt)
+        if not exitevt.is_set():
+            self.__send_kill(pid,sig)
+        else:
+            # reaped already, the pid may be of another process now
+            self.info('[%s] reaped, kill only the childs seen before %s',pid,cpids)
+        for p in cpids:
+            self.__send_kill(p,sig)
         return
 
     def __kill_proc(self,attr=None):
         maxwtime = None
+        killgrace = None
         if attr is not None:
             maxwtime = attr.maxwtime
+            killgrace = attr.killgrace
         exitcode = self.__retcode
         stime = time.time()
+        termtime = None
         if self.__p is not None:
+            # nobody reads the lines any more, so do not hold the child
+            self.__lift_limit()
+            if maxwtime is not None:
+                self.__see_childs(self.__p.pid,self.__exitevt)
             while True:
-                if self.errended and self.outended:
-                    break
-                if not self.errended:
-                    try:
-                        rl = self.enderr.get_nowait()
-                        if rl == 'done':
-                            self.errended = True
-                            self.enderr.join()
-                            self.enderr = None
-                    except Queue.Empty:
-                        pass
-                if not self.outended:
-                    try:
-                        rl = self.endout.get_nowait()
-                        if rl == 'done':
-                            self.outended = True
-                            self.endout.join()
-                            self.endout = None
-                    except Queue.Empty:
-                        pass
-                if not self.errended or not self.outended:
-                    # sleep for a while to get 
-                    if maxwtime is not None:
-                        ctime = time.time()
-                        if (ctime - stime) > maxwtime:
-                            self.info('[%s] kill[%s]'%(ctime,self.__p.pid))
-                            self.__kill_proc_childs(self.__p.pid)
-                    time.sleep(0.1)
+                with self.__cond:
+                    self.__check_ended()
+                    if self.errended and self.outended:
+                        break
+                    if maxwtime is None:
+                        self.__cond.wait()
+                        continue
+                    ctime = time.time()
+                    if (ctime - stime) <= maxwtime:
+                        self.__cond.wait(stime + maxwtime - ctime)
+                        continue
+                waittime = 0.1
+                if killgrace is not None and termtime is None:
+                    self.info('[%s] term[%s]',ctime,self.__p.pid)
+                    self.__kill_proc_childs(self.__p.pid,self.__exitevt,signal.SIGTERM)
+                    self.__kill_peers(signal.SIGTERM)
+                    termtime = ctime
+                    waittime = killgrace
+                elif termtime is not None and (ctime - termtime) < killgrace:
+                    waittime = termtime + killgrace - ctime
+                else:
+                    self.info('[%s] kill[%s]',ctime,self.__p.pid)
+                    self.__kill_proc_childs(self.__p.pid,self.__exitevt)
+                    self.__kill_peers()
+                # give the pipes a while to be closed before kill again
+                with self.__cond:
+                    self.__check_ended()
+                    if not self.errended or not self.outended:
+                        self.__cond.wait(waittime)
+            # the stages before may still run when the last one is done
+            if maxwtime is not None and not self.__wait_peers(stime + maxwtime):
+                self.__kill_peers()
         self.__retcode = exitcode
         return exitcode
 
-    def __del__(self):
-        # we do not clean_resource because on here we do not any more
-        attr = CmdObjectAttr()
-        attr.maxwtime = 0.01
-        self.__kill_proc(attr)
-        self.__clean_resource()
+    def __kill_peers(self,sig=None):
+        for p,evt in self.__peers:
+            if not evt.is_set():
+                self.info('kill peer [%s] sig [%s]',p.pid,sig)
+                self.__kill_proc_childs(p.pid,evt,sig)
+        return
+
+    def __wait_peers(self,etime=None):
+        for p,evt in self.__peers:
+            if etime is None:
+                evt.wait()
+            elif not evt.wait(max(etime - time.time(),0)):
+                return False
+        return True
+
+    def close(self):
+        with self.__cond:
+            eof = (self.__outeof and self.__erreof)
+        # the output is not all read, so nobody wants the rest
+        if not eof and self.__p is not None and not self.__exitevt.is_set():
+            self.kill()
+        return self.get_exitcode()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exctype,excvalue,tb):
+        self.close()
+        return False
+
+    def __wait_child(self,etime):
+        if not self.__exitevt.wait(max(etime - time.time(),0)):
+            return False
+        return self.__wait_peers(etime)
+
+    def __wait_end(self,etime):
+        if self.__p is None:
+            return True
+        self.__lift_limit()
+        with self.__cond:
+            while not self.__outeof or not self.__erreof:
+                ctime = time.time()
+                if ctime >= etime:
+                    return False
+                self.__cond.wait(etime - ctime)
+        return self.__wait_child(etime)
+
+    def kill(self,sig=None):
+        if self.__p is not None:
+            if not self.__exitevt.is_set():
+                self.__kill_proc_childs(self.__p.pid,self.__exitevt,sig)
+            self.__kill_peers(sig)
         return
 
-    def get_exitcode(self,attr=None):
+    def get_exitcode(self,attr=None,timeout=None):
+        if timeout is not None and not self.__wait_end(time.time() + timeout):
+            # the child is still running, call again or kill it by attr
+            raise CmdTimeoutError('wait [%s] timeout [%s]'%(self.__p.pid,timeout))
         self.__kill_proc(attr)
         return self.__clean_resource()
 
+    def get_exitcodes(self,attr=None,timeout=None):
+        exitcode = self.get_exitcode(attr,timeout)
+        return self.__peercodes + [exitcode]
+
     def is_running(self):
         if self.__p is not None:
-            pret = self.__p.poll()
-            if pret is not None:
+            if self.__exitevt.is_set() and self.__wait_peers(time.time()):
                 self.__get_exitcode()
                 return False
             return True
         return False
 
 
-def run_command_callback(cmd,callback,ctx,stdoutfile=subprocess.PIPE,stderrfile=None,shellmode=True,copyenv=None,linebuf=True):
-    cmdobj = _CmdRunObject(cmd,stdoutfile,stderrfile,shellmode,copyenv,[],linebuf)
-    cmdobj.call_readback(callback,ctx)
-    return cmdobj.get_exitcode()
+def run_command_callback(cmd,callback,ctx,stdoutfile=subprocess.PIPE,stderrfile=None,shellmode=True,copyenv=None,linebuf=True,reader=None,chunksize=1,encoding=None,errors='strict',binary=False,newpgrp=False,directmode=None,launcher=None,env_overrides=None,env_remove=None,max_buffered_bytes=None,max_buffered_lines=None,tee=None,forward=None,timeout=None,tagged=False,timestamps=False):
+    cmdobj = _CmdRunObject(cmd,stdoutfile,stderrfile,shellmode,copyenv,[],linebuf,reader,chunksize,encoding,errors,binary,newpgrp,directmode,launcher,env_overrides,env_remove,max_buffered_bytes,max_buffered_lines,tee=tee,forward=forward,tagged=tagged,timestamps=timestamps)
+    if timeout is None:
+        cmdobj.call_readback(callback,ctx)
+        return cmdobj.get_exitcode()
+    etime = time.time() + timeout
+    cmdobj.call_readback(callback,ctx,etime)
+    return __get_exitcode_or_kill(cmdobj,etime - time.time())
 
 
-def run_cmd_output(cmd,stdout=True,stderr=False,shellmode=True,copyenv=None,linebuf=True):
-    stdouttype = type(stdout)
+def __get_output_file(out,autoclosefds):
+    if isinstance(out,bool):
+        if out:
+            return subprocess.PIPE
+        f = open(os.devnull,'wb')
+        autoclosefds.append(f)
+        return f
+    elif isinstance(out,str) or (sys.version[0] == '2' and isinstance(out,unicode)):
+        f = open(out,'wb')
+        autoclosefds.append(f)
+        return f
+    return out
+
+def run_cmd_output(cmd,stdout=True,stderr=False,shellmode=True,copyenv=None,linebuf=True,reader=None,chunksize=1,encoding=None,errors='strict',binary=False,newpgrp=False,directmode=None,launcher=None,env_overrides=None,env_remove=None,max_buffered_bytes=None,max_buffered_lines=None,tail=None,tail_bytes=None,tee=None,forward=None,tagged=False,timestamps=False):
+    autoclosefds = []
+    stdoutfile = __get_output_file(stdout,autoclosefds)
+    stderrfile = __get_output_file(stderr,autoclosefds)
+    return _CmdRunObject(cmd,stdoutfile,stderrfile,shellmode,copyenv,autoclosefds,linebuf,reader,chunksize,encoding,errors,binary,newpgrp,directmode,launcher,env_overrides,env_remove,max_buffered_bytes,max_buffered_lines,tail,tail_bytes,tee,forward,tagged,timestamps)
+
+
+def __kill_pipeline_peers(peers):
+    for p,evt in peers:
+        try:
+            p.kill()
+        except OSError:
+            pass
+    return
+
+def pipeline(cmds,stdout=True,stderr=False,shellmode=True,copyenv=None,linebuf=True,reader=None,chunksize=1,encoding=None,errors='strict',binary=False,newpgrp=False,directmode=None,launcher=None,env_overrides=None,env_remove=None,max_buffered_bytes=None,max_buffered_lines=None,tail=None,tail_bytes=None,tee=None,forward=None,tagged=False,timestamps=False):
+    if len(cmds) == 0:
+        raise Exception('no command in pipeline')
     autoclosefds = []
-    if isinstance(stdout,bool):
-        if stdout:
-            stdoutfile=subprocess.PIPE
+    stdoutfile = __get_output_file(stdout,autoclosefds)
+    stderrfile = __get_output_file(stderr,autoclosefds)
+    peererr = stderrfile
+    if peererr == subprocess.PIPE:
+        # only the last stage can have the stderr pipe, so the others write to ours
+        peererr = None
+    peers = []
+    infd = None
+    try:
+        for cmd in cmds[:-1]:
+            rfd,wfd = os.pipe()
+            try:
+                p = run_read_cmd(cmd,wfd,peererr,shellmode,copyenv,linebuf,newpgrp,directmode,launcher,env_overrides,env_remove,infd)
+            except:
+                os.close(rfd)
+                raise
+            finally:
+                # the children have their copies, the pipes close when they exit
+                os.close(wfd)
+                if infd is not None:
+                    os.close(infd)
+                    infd = None
+            infd = rfd
+            evt = threading.Event()
+            _get_reaper().watch(p,evt)
+            peers.append((p,evt))
+        return _CmdRunObject(cmds[-1],stdoutfile,stderrfile,shellmode,copyenv,autoclosefds,linebuf,reader,chunksize,encoding,errors,binary,newpgrp,directmode,launcher,env_overrides,env_remove,max_buffered_bytes,max_buffered_lines,tail,tail_bytes,tee,forward,tagged,timestamps,infd,peers)
+    except:
+        __kill_pipeline_peers(peers)
+        for f in autoclosefds:
+            f.close()
+        raise
+    finally:
+        if infd is not None:
+            os.close(infd)
+
+
+class CmdCaptureResult(object):
+    __slots__ = ['cmd','exitcode','outbytes','errbytes','walltime','utime','stime','__encoding','__errors','__stdout','__stderr']
+
+    def __init__(self,cmd,exitcode,outbytes,errbytes,walltime,utime=None,stime=None,encoding=None,errors='strict'):
+        self.cmd = cmd
+        self.exitcode = exitcode
+        self.outbytes = outbytes
+        self.errbytes = errbytes
+        self.walltime = walltime
+        self.utime = utime
+        self.stime = stime
+        self.__encoding = encoding
+        self.__errors = errors
+        self.__stdout = None
+        self.__stderr = None
+        return
+
+    def __decode(self,data):
+        if self.__encoding is None and sys.version[0] != '3':
+            return bytes(data)
+        encoding = self.__encoding
+        fallback = None
+        if encoding is None:
+            encoding = 'UTF-8'
+            if self.__errors == 'strict':
+                fallback = 'latin-1'
+        decoder = _CmdStreamDecoder(encoding,self.__errors,fallback)
+        rets = decoder.decode(bytes(data),True)
+        error = decoder.pop_error()
+        if error is not None:
+            raise error
+        return rets
+
+    @property
+    def stdout(self):
+        if self.__stdout is None:
+            self.__stdout = self.__decode(self.outbytes)
+        return self.__stdout
+
+    @property
+    def stderr(self):
+        if self.__stderr is None:
+            self.__stderr = self.__decode(self.errbytes)
+        return self.__stderr
+
+    def __str__(self):
+        return 'cmd [%s] exitcode [%s] stdout [%d] stderr [%d] walltime [%.3f]'%(self.cmd,self.exitcode,len(self.outbytes),len(self.errbytes),self.walltime)
+
+def __kill_capture(p,newpgrp):
+    if sys.platform.lower() == 'win32':
+        p.kill()
+        return
+    if newpgrp:
+        try:
+            os.killpg(p.pid,signal.SIGKILL)
+        except OSError:
+            pass
+        return
+    cpids = get_child_pids(p.pid)
+    p.kill()
+    for c in cpids:
+        try:
+            os.kill(c,signal.SIGKILL)
+        except OSError:
+            pass
+    return
+
+def __capture_pipes(p,etime,newpgrp):
+    bufs = dict()
+    bufs[p.stdout.fileno()] = bytearray()
+    bufs[p.stderr.fileno()] = bytearray()
+    sel = selectors.DefaultSelector()
+    for fd in bufs.keys():
+        sel.register(fd,selectors.EVENT_READ,None)
+    count = len(bufs)
+    timeouted = False
+    try:
+        while count > 0:
+            waittime = None
+            if etime is not None and not timeouted:
+                waittime = max(etime - time.time(),0)
+            events = sel.select(waittime)
+            if len(events) == 0 and waittime is not None and time.time() >= etime:
+                __kill_capture(p,newpgrp)
+                timeouted = True
+                continue
+            for key,event in events:
+                data = os.read(key.fd,1048576)
+                if len(data) == 0:
+                    sel.unregister(key.fd)
+                    count -= 1
+                else:
+                    bufs[key.fd] += data
+    finally:
+        sel.close()
+    return bufs[p.stdout.fileno()],bufs[p.stderr.fileno()],timeouted
+
+def __wait_capture(p,etime=None,newpgrp=False):
+    timeouted = False
+    if hasattr(os,'wait4'):
+        try:
+            if etime is None:
+                pid,status,rusage = os.wait4(p.pid,0)
+            else:
+                # the child may close its pipes and still run, so the timeout goes on
+                waittime = 0.001
+                pid,status,rusage = os.wait4(p.pid,os.WNOHANG)
+                while pid == 0:
+                    ctime = time.time()
+                    if ctime >= etime:
+                        __kill_capture(p,newpgrp)
+                        timeouted = True
+                        pid,status,rusage = os.wait4(p.pid,0)
+                        break
+                    time.sleep(min(waittime,etime - ctime))
+                    waittime = min(waittime * 2,0.05)
+                    pid,status,rusage = os.wait4(p.pid,os.WNOHANG)
+        except ChildProcessError:
+            return p.wait(),None,None,timeouted
+        if os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
         else:
-            stdoutfile=open(os.devnull,'wb')
-            autoclosefds.append(stdoutfile)
-    elif isinstance(stdout,str) or (sys.version[0] == '2' and isinstance(stdout,unicode)) :
-        stdoutfile=open(stdout,'wb')
-        autoclosefds.append(stdoutfile)
-    else:
-        stdoutfile=stdout
+            p.returncode = os.WEXITSTATUS(status)
+        return p.returncode,rusage.ru_utime,rusage.ru_stime,timeouted
+    if etime is None:
+        return p.wait(),None,None,timeouted
+    try:
+        return p.wait(max(etime - time.time(),0)),None,None,timeouted
+    except subprocess.TimeoutExpired:
+        __kill_capture(p,newpgrp)
+        return p.wait(),None,None,True
 
-    if isinstance(stderr,bool):
-        if stderr:
-            stderrfile=subprocess.PIPE
+def run_cmd_capture(cmd,shellmode=True,copyenv=None,encoding=None,errors='strict',newpgrp=False,directmode=None,launcher=None,env_overrides=None,env_remove=None,timeout=None):
+    stime = time.time()
+    etime = None
+    if timeout is not None:
+        etime = stime + timeout
+    p = run_read_cmd(cmd,subprocess.PIPE,subprocess.PIPE,shellmode,copyenv,False,newpgrp,directmode,launcher,env_overrides,env_remove)
+    try:
+        if selectors is not None and sys.platform.lower() != 'win32':
+            outbytes,errbytes,timeouted = __capture_pipes(p,etime,newpgrp)
         else:
-            stderrfile=open(os.devnull,'wb')
-            autoclosefds.append(stderrfile)
-    elif isinstance(stderr,str) or (sys.version[0] == '2' and isinstance(stderr,unicode)):
-        stderrfile=open(stderr,'wb')
-        autoclosefds.append(stderrfile)
-    else:
-        stderrfile=stderr
-    return _CmdRunObject(cmd,stdoutfile,stderrfile,shellmode,copyenv,autoclosefds,linebuf)
+            timeouted = False
+            if timeout is None:
+                outdata,errdata = p.communicate()
+            else:
+                try:
+                    outdata,errdata = p.communicate(timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    __kill_capture(p,newpgrp)
+                    outdata,errdata = p.communicate()
+                    timeouted = True
+            outbytes = bytearray(outdata)
+            errbytes = bytearray(errdata)
+    finally:
+        p.stdout.close()
+        p.stderr.close()
+    if timeouted:
+        # killed already, only reap it
+        etime = None
+    exitcode,utime,systime,waittimeouted = __wait_capture(p,etime,newpgrp)
+    if timeouted or waittimeouted:
+        raise CmdTimeoutError('run (%s) timeout [%s]'%(cmd,timeout))
+    return CmdCaptureResult(cmd,exitcode,outbytes,errbytes,time.time() - stime,utime,systime,encoding,errors)
+
+
+class CmdPoolResult(object):
+    def __init__(self,cmd,exitcode,lines):
+        self.cmd = cmd
+        self.exitcode = exitcode
+        self.lines = lines
+        return
+
+    def __str__(self):
+        return 'cmd [%s] exitcode [%s] lines [%d]'%(self.cmd,self.exitcode,len(self.lines))
+
+class CommandPool(_LoggerObject):
+    def __init__(self,max_workers=4,reader=None):
+        super(CommandPool,self).__init__('cmdpack')
+        if futures is None:
+            raise Exception('CommandPool need concurrent.futures')
+        if max_workers < 1:
+            raise Exception('max_workers [%s] must be at least 1'%(max_workers))
+        if reader is None and selectors is not None and sys.platform.lower() != 'win32':
+            reader = 'shared'
+        self.__maxworkers = max_workers
+        self.__reader = reader
+        self.__cond = threading.Condition()
+        self.__pending = collections.deque()
+        self.__ended = collections.deque()
+        # the running jobs, nothing else holds them once their output is read
+        self.__jobs = dict()
+        self.__running = 0
+        self.__thread = None
+        self.__shutdown = False
+        return
+
+    def submit(self,cmd,stderr=False,shellmode=True,copyenv=None,linebuf=True,encoding=None,errors='strict',binary=False):
+        future = futures.Future()
+        job = [future,cmd,(stderr,shellmode,copyenv,linebuf,encoding,errors,binary),None]
+        with self.__cond:
+            if self.__shutdown:
+                raise Exception('submit after shutdown')
+            if self.__running >= self.__maxworkers:
+                self.__pending.append(job)
+                return future
+            self.__running += 1
+            self.__start_manager()
+        self.__start_job(job)
+        return future
+
+    def map(self,cmds,timeout=None,**kwargs):
+        # submit all now as Executor.map does, only the results are lazy
+        etime = None
+        if timeout is not None:
+            etime = time.time() + timeout
+        fs = []
+        for c in cmds:
+            fs.append(self.submit(c,**kwargs))
+        return self.__iter_results(fs,etime)
+
+    def __iter_results(self,fs,etime):
+        for f in fs:
+            wtime = None
+            if etime is not None:
+                wtime = max(etime - time.time(),0)
+            yield f.result(wtime)
+        return
+
+    def as_completed(self,fs,timeout=None):
+        return futures.as_completed(fs,timeout)
+
+    def shutdown(self,wait=True):
+        with self.__cond:
+            self.__shutdown = True
+            if wait:
+                while self.__running > 0 or len(self.__pending) > 0:
+                    self.__cond.wait()
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exctype,excvalue,tb):
+        self.shutdown(True)
+        return False
+
+    def __start_manager(self):
+        # must be called with __cond held
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__run_manager)
+            self.__thread.daemon = True
+            self.__thread.start()
+        return
+
+    def __start_job(self,job):
+        future = job[0]
+        if not future.set_running_or_notify_cancel():
+            self.__job_ended(None,job)
+            return
+        stderr,shellmode,copyenv,linebuf,encoding,errors,binary = job[2]
+        try:
+            stderrfile = open(os.devnull,'wb')
+            autoclosefds = [stderrfile]
+            if stderr:
+                stderrfile.close()
+                stderrfile = subprocess.PIPE
+                autoclosefds = []
+            job[3] = _CmdRunObject(job[1],subprocess.PIPE,stderrfile,shellmode,copyenv,autoclosefds,linebuf,self.__reader,0,encoding,errors,binary)
+            with self.__cond:
+                self.__jobs[id(job)] = job
+        except Exception as e:
+            self.info('start [%s] error [%s]',job[1],e)
+            future.set_exception(e)
+            self.__job_ended(None,job)
+            return
+        job[3].add_end_callback(self.__job_ended,job)
+        return
+
+    def __job_ended(self,cmdobj,job):
+        with self.__cond:
+            self.__ended.append(job)
+            self.__cond.notify_all()
+        return
+
+    def __finish_job(self,job):
+        cmdobj = job[3]
+        if cmdobj is None:
+            return
+        job[3] = None
+        with self.__cond:
+            self.__jobs.pop(id(job),None)
+        try:
+            lines = []
+            for l in cmdobj:
+                lines.append(l)
+            exitcode = cmdobj.get_exitcode()
+            job[0].set_result(CmdPoolResult(job[1],exitcode,lines))
+        except Exception as e:
+            job[0].set_exception(e)
+        return
+
+    def __run_manager(self):
+        while True:
+            with self.__cond:
+                while len(self.__ended) == 0:
+                    if self.__running == 0 and len(self.__pending) == 0:
+                        self.__thread = None
+                        self.__cond.notify_all()
+                        return
+                    self.__cond.wait()
+                ended = self.__ended
+                self.__ended = collections.deque()
+            for job in ended:
+                self.__finish_job(job)
+            startjobs = []
+            with self.__cond:
+                self.__running -= len(ended)
+                while self.__running < self.__maxworkers and len(self.__pending) > 0:
+                    startjobs.append(self.__pending.popleft())
+                    self.__running += 1
+                self.__cond.notify_all()
+            for job in startjobs:
+                self.__start_job(job)
+        return
 
 
 
 ##importdebugstart
 import unittest
 import tempfile
+import gc
 
 
 
@@ -826,6 +2507,18 @@ def norettime_err(args):
     noret_put(float(args[0]),args[1:],sys.stderr)
     return
 
+def noretbytes_out(args):
+    fout = sys.stdout
+    if sys.version[0] == '3':
+        fout = sys.stdout.buffer
+    wtime = float(args[0])
+    for c in args[1:]:
+        fout.write(codecs.decode(c,'hex'))
+        fout.flush()
+        if wtime > 0.01:
+            time.sleep(wtime)
+    return
+
 ##handleoutend
 
 
@@ -1348,6 +3041,1179 @@ class debug_cmdpack_case(unittest.TestCase):
         del p
         return
 
+    def test_A021(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('cmdout')
+        p = run_cmd_output(cmds)
+        stime = time.time()
+        rlines = p.get_lines(10.0,1)
+        etime = time.time()
+        self.assertEqual(len(rlines),0)
+        self.assertTrue(p.outended)
+        # eof must wake up the waiter, not the timeout
+        self.assertTrue((etime - stime) < 5.0)
+        exitcode = p.get_exitcode()
+        self.assertEqual(exitcode,0)
+        return
+
+    def test_A022(self):
+        procs = []
+        for i in range(20):
+            cmds = []
+            cmds.append('%s'%(sys.executable))
+            cmds.append(__file__)
+            cmds.append('cmdout')
+            cmds.append('out%d'%(i))
+            cmds.append('line%d'%(i))
+            procs.append(run_cmd_output(cmds,reader='shared'))
+        # one shared io thread for all the children
+        self.assertTrue(threading.active_count() < 5)
+        i = 0
+        for p in procs:
+            rlines = []
+            for l in p:
+                rlines.append(l.rstrip('\r\n'))
+            self.assertEqual(rlines,['out%d'%(i),'line%d'%(i)])
+            self.assertEqual(p.get_exitcode(),0)
+            i += 1
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('cmderr')
+        cmds.extend(['001','002'])
+        rlines = []
+        for l in run_cmd_output(cmds,stdout=False,stderr=True,reader='thread'):
+            rlines.append(l.rstrip('\r\n'))
+        self.assertEqual(rlines,['001','002'])
+        return
+
+    def test_A023(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('norettimeout')
+        cmds.append('0.0')
+        cmds.extend(['hello','world'])
+        p = run_cmd_output(cmds,linebuf=False,chunksize=0)
+        s = ''
+        for l in p:
+            s += l
+        self.assertEqual(s,'helloworld')
+        # utf-8 of the chinese char split in two writes
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('noretbytesout')
+        cmds.append('0.3')
+        cmds.extend(['61e4b8','ad62'])
+        p = run_cmd_output(cmds,linebuf=False,chunksize=4096)
+        s = ''
+        for l in p:
+            s += l
+        if sys.version[0] == '3':
+            self.assertEqual(s,codecs.decode(b'61e4b8ad62','hex').decode('UTF-8'))
+        self.assertEqual(p.get_exitcode(),0)
+        return
+
+    def test_A024(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('noretbytesout')
+        cmds.append('0.0')
+        # first line is utf-8 , the second is not valid utf-8
+        cmds.extend(['e4b8ad0a','ff0a'])
+        rlines = []
+        for l in run_cmd_output(cmds):
+            rlines.append(l)
+        self.assertEqual(len(rlines),2)
+        if sys.version[0] == '3':
+            self.assertEqual(rlines[0],'\u4e2d\n')
+            self.assertEqual(rlines[1],'\u00ff\n')
+        rlines = []
+        for l in run_cmd_output(cmds,encoding='UTF-8',errors='replace'):
+            rlines.append(l)
+        self.assertEqual(len(rlines),2)
+        self.assertEqual(rlines[0],u'\u4e2d\n')
+        self.assertEqual(rlines[1],u'\ufffd\n')
+        rlines = []
+        for l in run_cmd_output(cmds,encoding='latin-1'):
+            rlines.append(l)
+        self.assertEqual(rlines[1],u'\u00ff\n')
+        return
+
+    def test_A025(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('noretbytesout')
+        cmds.append('0.0')
+        cmds.extend(['e4b8ad0a','ff0aff'])
+        rlines = []
+        for l in run_cmd_output(cmds,binary=True):
+            rlines.append(l)
+        self.assertEqual(rlines,[b'\xe4\xb8\xad\n',b'\xff\n',b'\xff'])
+        p = run_cmd_output(cmds,binary=True,linebuf=False,chunksize=0)
+        s = b''
+        for l in p:
+            self.assertTrue(isinstance(l,bytes))
+            s += l
+        self.assertEqual(s,b'\xe4\xb8\xad\n\xff\n\xff')
+        self.assertEqual(p.get_exitcode(),0)
+        return
+
+    def test_A026(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('cmdout')
+        outnum = 100
+        for i in range(outnum):
+            cmds.append('%d'%(i))
+        p = run_cmd_output(cmds)
+        rlines = p.get_lines(5.0,1)
+        self.assertEqual(len(rlines),1)
+        self.assertEqual(rlines[0].rstrip('\r\n'),'0')
+        rlines = p.get_lines(5.0,outnum - 1,outnum * 2)
+        self.assertEqual(len(rlines),outnum - 1)
+        for i in range(len(rlines)):
+            self.assertEqual(rlines[i].rstrip('\r\n'),'%d'%(i+1))
+        rlines = p.get_lines(5.0,1,10)
+        self.assertEqual(len(rlines),0)
+        self.assertTrue(p.outended)
+        self.assertEqual(p.get_exitcode(),0)
+        return
+
+    def test_A027(self):
+        if not os.path.isdir('/proc'):
+            return
+        cmd = []
+        cmd.append('/bin/sh')
+        cmd.append('-c')
+        cmd.append('sleep 10 & sleep 10 & wait')
+        p = subprocess.Popen(cmd)
+        try:
+            snap = None
+            stime = time.time()
+            while (time.time() - stime) < 5.0:
+                snap = ProcTreeSnapshot()
+                if len(snap.get_child_pids(p.pid)) >= 2:
+                    break
+                time.sleep(0.1)
+            cpids = snap.get_child_pids(p.pid)
+            self.assertEqual(len(cpids),2)
+            self.assertEqual(get_child_pids(p.pid,True,snap),cpids)
+            self.assertEqual(get_child_pids(p.pid,False,snap),cpids)
+            self.assertEqual(sorted(get_child_pids(p.pid)),sorted(cpids))
+            self.assertEqual(snap.get_child_pids(cpids[0]),[])
+            self.assertTrue(p.pid in get_child_pids(os.getpid()))
+        finally:
+            for c in get_child_pids(p.pid):
+                os.kill(c,9)
+            p.wait()
+        return
+
+    def test_A028(self):
+        if sys.platform.lower() == 'win32':
+            return
+        for newpgrp in [False,True]:
+            cmds = []
+            cmds.append('%s'%(sys.executable))
+            cmds.append(__file__)
+            cmds.append('outtime')
+            cmds.extend(['cc','bb','dd','ee','ff'])
+            p = run_cmd_output(cmds,newpgrp=newpgrp)
+            rlines = p.get_lines(5.0,1)
+            self.assertEqual(len(rlines),1)
+            stime = time.time()
+            attr = CmdObjectAttr()
+            attr.maxwtime = 0.1
+            attr.killgrace = 1.0
+            exitcode = p.get_exitcode(attr)
+            etime = time.time()
+            # python exits on SIGTERM, so no SIGKILL needed
+            self.assertEqual(exitcode,-signal.SIGTERM)
+            self.assertTrue((etime - stime) < 1.0)
+        # SIGTERM ignored, so SIGKILL after the grace time
+        cmds = ['/bin/sh','-c','trap "" TERM; echo start; sleep 5']
+        p = run_cmd_output(cmds,shellmode=False,newpgrp=True)
+        rlines = p.get_lines(5.0,1)
+        self.assertEqual(len(rlines),1)
+        stime = time.time()
+        attr = CmdObjectAttr()
+        attr.maxwtime = 0.1
+        attr.killgrace = 0.3
+        exitcode = p.get_exitcode(attr)
+        etime = time.time()
+        self.assertEqual(exitcode,-signal.SIGKILL)
+        self.assertTrue((etime - stime) > 0.3)
+        self.assertTrue((etime - stime) < 3.0)
+        return
+
+    def test_A029(self):
+        if futures is None:
+            return
+        cmdss = []
+        for i in range(8):
+            cmds = []
+            cmds.append('%s'%(sys.executable))
+            cmds.append(__file__)
+            cmds.append('cmdout')
+            cmds.append('out%d'%(i))
+            cmdss.append(cmds)
+        errcmds = []
+        errcmds.append('%s'%(sys.executable))
+        errcmds.append(__file__)
+        errcmds.append('errorout')
+        errcmds.append('bad')
+        with CommandPool(max_workers=3) as pool:
+            i = 0
+            for r in pool.map(cmdss):
+                self.assertEqual(r.exitcode,0)
+                self.assertEqual(len(r.lines),1)
+                self.assertEqual(r.lines[0].rstrip('\r\n'),'out%d'%(i))
+                i += 1
+            self.assertEqual(i,len(cmdss))
+            fs = []
+            for cmds in cmdss:
+                fs.append(pool.submit(cmds))
+            fs.append(pool.submit(errcmds))
+            cnt = 0
+            for f in pool.as_completed(fs,30.0):
+                r = f.result()
+                if r.cmd == errcmds:
+                    self.assertTrue(r.exitcode != 0)
+                    self.assertEqual(r.lines[0].rstrip('\r\n'),'bad')
+                else:
+                    self.assertEqual(r.exitcode,0)
+                cnt += 1
+            self.assertEqual(cnt,len(fs))
+        return
+
+    def test_A030(self):
+        if sys.version_info < (3,5):
+            return
+        try:
+            from cmdpack import aio as cmdpack_aio
+        except ImportError:
+            import aio as cmdpack_aio
+        import asyncio
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('cmdout')
+        cmds.extend(['cc','bb','dd'])
+        loop = asyncio.new_event_loop()
+        try:
+            p = loop.run_until_complete(cmdpack_aio.run_cmd_output(cmds))
+            rlines = loop.run_until_complete(p.get_lines(5.0,2))
+            self.assertEqual(len(rlines),2)
+            self.assertEqual(rlines[0].rstrip('\r\n'),'cc')
+            self.assertEqual(rlines[1].rstrip('\r\n'),'bb')
+            l = loop.run_until_complete(p.__anext__())
+            self.assertEqual(l.rstrip('\r\n'),'dd')
+            self.assertEqual(loop.run_until_complete(p.get_exitcode()),0)
+            cmds = []
+            cmds.append('%s'%(sys.executable))
+            cmds.append(__file__)
+            cmds.append('outtime')
+            cmds.extend(['cc','bb','dd','ee','ff'])
+            p = loop.run_until_complete(cmdpack_aio.run_cmd_output(cmds,stderr=True))
+            rlines = loop.run_until_complete(p.get_lines(5.0,1))
+            self.assertEqual(len(rlines),1)
+            attr = CmdObjectAttr()
+            attr.maxwtime = 0.1
+            stime = time.time()
+            exitcode = loop.run_until_complete(p.get_exitcode(attr))
+            self.assertTrue(exitcode != 0)
+            self.assertTrue((time.time() - stime) < 3.0)
+        finally:
+            loop.close()
+        return
+
+    def test_A031(self):
+        if sys.platform.lower() == 'win32':
+            return
+        self.assertEqual(shell_quote_string('hello'),'hello')
+        self.assertEqual(shell_quote_string('"hello"'),'\\"hello\\"')
+        self.assertEqual(shell_quote_string('\\good\\'),'\\\\good\\\\')
+        self.assertEqual(shell_quote_string('`new $x`'),'\\`new $x\\`')
+        # from cache
+        self.assertEqual(shell_quote_string('"hello"'),'\\"hello\\"')
+        self.assertEqual(format_list_to_shell_cmd(['a b','c"d','']),'"a b" "c\\"d" ""')
+        self.assertEqual(format_list_to_shell_cmd([]),'')
+        return
+
+    def __read_cmd_lines(self,cmds,directmode=None):
+        p = run_read_cmd(cmds,stderrfile=None,directmode=directmode)
+        rlines = []
+        for l in p.stdout:
+            rlines.append(l.decode('UTF-8').rstrip('\r\n'))
+        p.stdout.close()
+        p.wait()
+        return rlines
+
+    def test_A032(self):
+        if sys.platform.lower() == 'win32':
+            return
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('cmdout')
+        cmds.extend(['"a b"','c\\d','`e`'])
+        self.assertEqual(self.__read_cmd_lines(cmds),['"a b"','c\\d','`e`'])
+        self.assertEqual(self.__read_cmd_lines(cmds,False),['"a b"','c\\d','`e`'])
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('cmdout')
+        cmds.append('a$CMDPACK_NOT_SET_ENV')
+        # $ must go to the shell , unless forced
+        self.assertEqual(self.__read_cmd_lines(cmds),['a'])
+        self.assertEqual(self.__read_cmd_lines(cmds,'force'),['a$CMDPACK_NOT_SET_ENV'])
+        self.assertEqual(run_cmd_wait(['cmdpack_not_exist_command'],0),127)
+        self.assertEqual(run_cmd_wait(['cd','/'],0),0)
+        return
+
+    def test_A033(self):
+        if not hasattr(os,'posix_spawnp') or sys.platform.lower() in ['win32','cygwin']:
+            return
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('cmdout')
+        cmds.extend(['hello','world'])
+        for launcher in ['spawn','popen']:
+            p = run_read_cmd(cmds,stderrfile=None,launcher=launcher)
+            if launcher == 'spawn':
+                self.assertTrue(isinstance(p,SpawnPopen))
+            else:
+                self.assertTrue(isinstance(p,subprocess.Popen))
+            self.assertEqual(p.stdout.read(),b'hello\nworld\n')
+            p.stdout.close()
+            self.assertEqual(p.wait(),0)
+            rlines = []
+            for l in run_cmd_output(cmds,launcher=launcher):
+                rlines.append(l.rstrip('\r\n'))
+            self.assertEqual(rlines,['hello','world'])
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('cmderr')
+        cmds.extend(['err1'])
+        p = run_read_cmd(cmds,stderrfile=subprocess.STDOUT,launcher='spawn')
+        self.assertEqual(p.stdout.read(),b'err1\n')
+        p.stdout.close()
+        self.assertEqual(p.wait(),0)
+        self.assertRaises(OSError,run_read_cmd,['cmdpack_not_exist_command'],shellmode=False,launcher='spawn')
+        p = run_cmd_output(['/bin/sh','-c','echo start; sleep 5'],shellmode=False,newpgrp=True,launcher='spawn')
+        self.assertEqual(len(p.get_lines(5.0,1)),1)
+        attr = CmdObjectAttr()
+        attr.maxwtime = 0.1
+        self.assertEqual(p.get_exitcode(attr),-signal.SIGKILL)
+        self.assertRaises(Exception,set_launcher,'fork')
+        return
+
+    def test_A034(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append('-c')
+        cmds.append('import os;print(os.environ.get("CMDPACK_A034_SET","")+":"+os.environ.get("CMDPACK_A034_DEL","none"))')
+        os.environ['CMDPACK_A034_DEL'] = 'del'
+        try:
+            for i in range(2):
+                rlines = []
+                for l in run_cmd_output(cmds,shellmode=False,env_overrides={'CMDPACK_A034_SET':'set'},env_remove=['CMDPACK_A034_DEL']):
+                    rlines.append(l.rstrip('\r\n'))
+                self.assertEqual(rlines,['set:none'])
+            rlines = []
+            for l in run_cmd_output(cmds,shellmode=False):
+                rlines.append(l.rstrip('\r\n'))
+            self.assertEqual(rlines,[':del'])
+            # os.environ changed, so the cached one is not used
+            os.environ['CMDPACK_A034_DEL'] = 'del2'
+            rlines = []
+            for l in run_cmd_output(cmds,shellmode=False,env_overrides={'CMDPACK_A034_SET':'set'}):
+                rlines.append(l.rstrip('\r\n'))
+            self.assertEqual(rlines,['set:del2'])
+            rlines = []
+            for l in run_cmd_output(cmds,shellmode=False,copyenv={'PATH':os.environ.get('PATH','')},env_overrides={'CMDPACK_A034_SET':'set'}):
+                rlines.append(l.rstrip('\r\n'))
+            self.assertEqual(rlines,['set:none'])
+            self.assertEqual(run_cmd_wait(cmds,0,shellmode=False,env_remove=['PATH']),0)
+        finally:
+            del os.environ['CMDPACK_A034_DEL']
+        return
+
+    def test_A035(self):
+        class StrCount(object):
+            def __init__(self):
+                self.cnt = 0
+                return
+            def __str__(self):
+                self.cnt += 1
+                return 'strcount'
+        class RecordHandler(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.msgs = []
+                return
+            def emit(self,record):
+                self.msgs.append(record.getMessage())
+                return
+        handler = RecordHandler()
+        logobj = _LoggerObject('cmdpack_a035')
+        logger = logging.getLogger('cmdpack_a035')
+        oldhandlers = list(logger.handlers)
+        oldlevel = logger.level
+        oldpropagate = logger.propagate
+        try:
+            # only to our handler, not to the output of the tests
+            logger.propagate = False
+            for h in oldhandlers:
+                logger.removeHandler(h)
+            logger.addHandler(handler)
+            logger.setLevel(logging.WARN)
+            sc = StrCount()
+            logobj.info('value [%s]',sc)
+            logobj.debug('value [%s]',sc)
+            self.assertEqual(sc.cnt,0)
+            self.assertEqual(handler.msgs,[])
+            logobj.warn('value [%s] [%d]',sc,3,callstack=None)
+            self.assertEqual(sc.cnt,1)
+            self.assertEqual(handler.msgs,['value [strcount] [3]'])
+            logger.setLevel(logging.INFO)
+            logobj.info('100%')
+            self.assertEqual(handler.msgs[-1].endswith('] 100%'),True)
+            self.assertTrue('test_A035' in handler.msgs[-1])
+        finally:
+            for h in list(logger.handlers):
+                logger.removeHandler(h)
+            for h in oldhandlers:
+                logger.addHandler(h)
+            logger.setLevel(oldlevel)
+            logger.propagate = oldpropagate
+        return
+
+    def test_A036(self):
+        class RecordHandler(logging.Handler):
+            def __init__(self):
+                logging.Handler.__init__(self)
+                self.msgs = []
+                return
+            def emit(self,record):
+                self.msgs.append(self.format(record))
+                return
+        logger = logging.getLogger('cmdpack')
+        oldhandlers = list(logger.handlers)
+        oldlevel = logger.level
+        oldpropagate = logger.propagate
+        handler = RecordHandler()
+        try:
+            # only to our handler, not to the root handler of the tests
+            logger.propagate = False
+            self.assertTrue(configure_logging(logging.INFO,'A036 %(message)s',handler) is logger)
+            self.assertEqual(logger.handlers,[handler])
+            cmds = []
+            cmds.append('%s'%(sys.executable))
+            cmds.append(__file__)
+            cmds.append('cmdout')
+            cmds.append('hello')
+            rlines = []
+            for l in run_cmd_output(cmds,linebuf=False,chunksize=0):
+                rlines.append(l)
+            self.assertEqual(''.join(rlines),'hello\n')
+            self.assertTrue(len(handler.msgs) > 0)
+            self.assertTrue(handler.msgs[0].startswith('A036 '))
+            cnt = len([m for m in handler.msgs if 'read no line feed' in m])
+            self.assertTrue(cnt > 0)
+            configure_logging(logging.WARN)
+            handler.msgs = []
+            for l in run_cmd_output(cmds,linebuf=False,chunksize=0):
+                pass
+            self.assertEqual(handler.msgs,[])
+        finally:
+            logger.removeHandler(handler)
+            for h in oldhandlers:
+                logger.addHandler(h)
+            configure_logging(oldlevel)
+            logger.propagate = oldpropagate
+        return
+
+    def test_A037(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append('-c')
+        cmds.append('import sys\nfor i in range(20000):\n    sys.stdout.write("%099d\\n"%(i))\n')
+        readers = ['thread']
+        if selectors is not None and sys.platform.lower() != 'win32':
+            readers.extend(['selector','shared'])
+        for reader in readers:
+            for maxbytes,maxlines in [(None,100),(10000,None)]:
+                p = run_cmd_output(cmds,shellmode=False,reader=reader,max_buffered_bytes=maxbytes,max_buffered_lines=maxlines)
+                time.sleep(0.3)
+                cnt = 0
+                while True:
+                    rlines = p.get_lines(5.0,1,50)
+                    if len(rlines) == 0:
+                        break
+                    cnt += len(rlines)
+                self.assertEqual(p.get_exitcode(),0)
+                self.assertEqual(cnt,20000)
+                # one read can go over the limit
+                self.assertTrue(p.highwaterlines < 2000)
+                self.assertTrue(p.highwaterbytes < 200000)
+            p = run_cmd_output(cmds,shellmode=False,reader=reader)
+            time.sleep(0.3)
+            cnt = 0
+            for l in p:
+                cnt += 1
+            self.assertEqual(cnt,20000)
+            self.assertTrue(p.highwaterlines > 2000)
+            # not read at all, get_exitcode must not hang
+            p = run_cmd_output(cmds,shellmode=False,reader=reader,max_buffered_lines=10)
+            self.assertEqual(p.get_exitcode(),0)
+        return
+
+    def test_A038(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append('-c')
+        cmds.append('import sys\nfor i in range(5000):\n    sys.stdout.write("line%d\\n"%(i))\nsys.stderr.write("failed\\n")\nsys.exit(3)\n')
+        p = run_cmd_output(cmds,shellmode=False,tail=3)
+        rlines = []
+        for l in p:
+            rlines.append(l)
+        self.assertEqual(rlines,[])
+        self.assertEqual(p.get_exitcode(),3)
+        self.assertEqual(p.get_tail(),['line4997\n','line4998\n','line4999\n'])
+        p = run_cmd_output(cmds,shellmode=False,tail_bytes=12)
+        self.assertEqual(p.get_exitcode(),3)
+        self.assertEqual(''.join(p.get_tail()),'98\nline4999\n')
+        p = run_cmd_output(cmds,shellmode=False,tail=2,tail_bytes=100)
+        self.assertEqual(p.get_exitcode(),3)
+        self.assertEqual(p.get_tail(),['line4998\n','line4999\n'])
+        self.assertEqual(run_cmd_wait(cmds,0,shellmode=False,tail=2),3)
+        try:
+            run_cmd_wait(cmds,shellmode=False,tail=2)
+            self.assertTrue(False)
+        except Exception as e:
+            self.assertTrue(str(e).endswith('line4999\nfailed\n'))
+        return
+
+    def __read_file_bytes(self,f):
+        with open(f,'rb') as fin:
+            return fin.read()
+
+    def test_A039(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append('-c')
+        cmds.append('import sys\nfor i in range(5000):\n    sys.stdout.write("line%d\\n"%(i))\n')
+        alls = ''.join(['line%d\n'%(i) for i in range(5000)])
+        tempf = make_tempfile()
+        tempf2 = make_tempfile()
+        try:
+            rlines = []
+            for l in run_cmd_output(cmds,shellmode=False,tee=tempf):
+                rlines.append(l)
+            self.assertEqual(''.join(rlines),alls)
+            self.assertEqual(self.__read_file_bytes(tempf),alls.encode('UTF-8'))
+            # nothing forwarded, spliced into the file on linux
+            p = run_cmd_output(cmds,shellmode=False,tee=tempf,forward='none')
+            rlines = []
+            for l in p:
+                rlines.append(l)
+            self.assertEqual(rlines,[])
+            self.assertEqual(p.get_exitcode(),0)
+            self.assertEqual(self.__read_file_bytes(tempf),alls.encode('UTF-8'))
+            with open(tempf,'wb') as fout:
+                fout.write(b'head\n')
+            with open(tempf,'ab') as fapp:
+                with open(tempf2,'wb') as fout2:
+                    rlines = []
+                    for l in run_cmd_output(cmds,shellmode=False,tee=[fapp,fout2.fileno()],forward=r'99$'):
+                        rlines.append(l)
+            self.assertEqual(rlines,['line99\n'] + ['line%d99\n'%(i) for i in range(1,50)])
+            self.assertEqual(self.__read_file_bytes(tempf),b'head\n' + alls.encode('UTF-8'))
+            self.assertEqual(self.__read_file_bytes(tempf2),alls.encode('UTF-8'))
+            # O_APPEND file can not be spliced into
+            with open(tempf,'ab') as fapp:
+                p = run_cmd_output(cmds,shellmode=False,tee=fapp,forward='none')
+                self.assertEqual(p.get_exitcode(),0)
+            self.assertEqual(self.__read_file_bytes(tempf),b'head\n' + (alls * 2).encode('UTF-8'))
+            rlines = []
+            for l in run_cmd_output(cmds,shellmode=False,tee=tempf2,forward=1000):
+                rlines.append(l)
+            self.assertEqual(rlines,['line0\n','line1000\n','line2000\n','line3000\n','line4000\n'])
+        finally:
+            os.remove(tempf)
+            os.remove(tempf2)
+        return
+
+    def __a040_callback(self,rl,ctx):
+        ctx.append(rl)
+        return
+
+    def test_A040(self):
+        sleepcmds = ['%s'%(sys.executable),'-c','import time\ntime.sleep(5)\n']
+        p = run_cmd_output(sleepcmds,shellmode=False)
+        stime = time.time()
+        self.assertRaises(CmdTimeoutError,p.get_exitcode,None,0.2)
+        etime = time.time()
+        self.assertTrue((etime - stime) >= 0.2)
+        self.assertTrue((etime - stime) < 1.0)
+        attr = CmdObjectAttr()
+        attr.maxwtime = 0
+        exitcode = p.get_exitcode(attr)
+        if sys.platform.lower() != 'win32':
+            self.assertEqual(exitcode,-signal.SIGKILL)
+        # stdout closed, but the child still runs
+        p = run_cmd_output(['%s'%(sys.executable),'-c','import os,time\nos.close(1)\ntime.sleep(5)\n'],shellmode=False)
+        stime = time.time()
+        self.assertRaises(CmdTimeoutError,p.get_exitcode,None,0.2)
+        self.assertTrue((time.time() - stime) < 1.0)
+        p.kill()
+        stime = time.time()
+        p.get_exitcode()
+        self.assertTrue((time.time() - stime) < 1.0)
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('cmdout')
+        cmds.append('hello')
+        p = run_cmd_output(cmds)
+        self.assertEqual(p.get_exitcode(timeout=5.0),0)
+        self.assertEqual(run_cmd_wait(cmds,timeout=5.0),0)
+        stime = time.time()
+        self.assertRaises(CmdTimeoutError,run_cmd_wait,sleepcmds,shellmode=False,timeout=0.2)
+        self.assertTrue((time.time() - stime) < 1.5)
+        rlines = []
+        stime = time.time()
+        self.assertRaises(CmdTimeoutError,run_command_callback,['%s'%(sys.executable),'-c','import sys,time\nsys.stdout.write("start\\n")\nsys.stdout.flush()\ntime.sleep(5)\n'],self.__a040_callback,rlines,shellmode=False,timeout=0.5)
+        self.assertTrue((time.time() - stime) < 2.0)
+        self.assertEqual(rlines,['start\n'])
+        self.assertEqual(run_command_callback(cmds,self.__a040_callback,rlines,timeout=5.0),0)
+        self.assertEqual(rlines,['start\n','hello\n'])
+        return
+
+    def test_A041(self):
+        cmds = ['%s'%(sys.executable),'-c','import sys,time\nsys.stdout.write("start\\n")\nsys.stdout.flush()\ntime.sleep(5)\n']
+        stime = time.time()
+        with run_cmd_output(cmds,shellmode=False) as p:
+            self.assertEqual(p.get_lines(5.0,1),['start\n'])
+        self.assertTrue((time.time() - stime) < 3.0)
+        if sys.platform.lower() != 'win32':
+            self.assertEqual(p.get_exitcode(),-signal.SIGKILL)
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append(__file__)
+        cmds.append('cmdout')
+        cmds.append('hello')
+        p = run_cmd_output(cmds)
+        self.assertEqual(p.get_lines(5.0,1),['hello\n'])
+        self.assertEqual(p.get_lines(5.0,1),[])
+        self.assertEqual(p.close(),0)
+        if not sys.platform.lower().startswith('linux'):
+            return
+        tempf = make_tempfile()
+        try:
+            cmds = ['%s'%(sys.executable),'-c','import os,sys,time\nsys.stdout.write("%d\\n"%(os.getpid()))\nsys.stdout.flush()\ntime.sleep(0.5)\n']
+            p = run_cmd_output(cmds,shellmode=False,stdout=tempf)
+            stime = time.time()
+            pid = None
+            while pid is None and (time.time() - stime) < 5.0:
+                with open(tempf,'r') as fin:
+                    s = fin.read()
+                if s.endswith('\n'):
+                    pid = int(s)
+                else:
+                    time.sleep(0.01)
+            self.assertTrue(pid is not None)
+            stime = time.time()
+            # dropped with the child still running, must not wait for it
+            p = None
+            self.assertTrue((time.time() - stime) < 0.2)
+            while os.path.exists('/proc/%d'%(pid)) and (time.time() - stime) < 5.0:
+                time.sleep(0.05)
+            self.assertFalse(os.path.exists('/proc/%d'%(pid)))
+        finally:
+            os.remove(tempf)
+        return
+
+    def test_A042(self):
+        cmds = ['%s'%(sys.executable),'-c','import time\ntime.sleep(0.3)\n']
+        p = run_cmd_output(cmds,shellmode=False,stdout=False)
+        self.assertTrue(p.is_running())
+        stime = time.time()
+        while p.is_running():
+            time.sleep(0.01)
+            self.assertTrue((time.time() - stime) < 5.0)
+        self.assertEqual(p.get_exitcode(),0)
+        for usepidfd in [False,True]:
+            if usepidfd and (not hasattr(os,'pidfd_open') or selectors is None):
+                continue
+            reaper = _CmdReaper(usepidfd)
+            plist = []
+            for i in range(3):
+                p = subprocess.Popen(['%s'%(sys.executable),'-c','import sys,time\ntime.sleep(0.1 * %d)\nsys.exit(%d)\n'%(i,i)])
+                evt = threading.Event()
+                reaper.watch(p,evt)
+                plist.append((p,evt))
+            i = 0
+            for p,evt in plist:
+                self.assertTrue(evt.wait(5.0))
+                self.assertEqual(p.returncode,i)
+                i += 1
+        return
+
+    def test_A043(self):
+        cmds = ['%s'%(sys.executable),'-c','import sys\nsys.stdout.write("x" * 3000000)\nsys.stdout.write("\\nend\\n")\nsys.stderr.write("err\\n")\nsys.exit(3)\n']
+        r = run_cmd_capture(cmds,shellmode=False)
+        self.assertFalse(hasattr(r,'__dict__'))
+        self.assertEqual(r.exitcode,3)
+        self.assertTrue(isinstance(r.outbytes,bytearray))
+        self.assertEqual(len(r.outbytes),3000005)
+        self.assertEqual(bytes(r.errbytes),b'err\n')
+        self.assertTrue(r.stdout.endswith('x\nend\n'))
+        self.assertTrue(r.stdout is r.stdout)
+        self.assertEqual(r.stderr,'err\n')
+        self.assertTrue(r.walltime > 0)
+        if hasattr(os,'wait4'):
+            self.assertTrue(r.utime is not None and r.utime >= 0)
+            self.assertTrue(r.stime is not None and r.stime >= 0)
+        r = run_cmd_capture(['%s'%(sys.executable),'-c','import sys\nsys.stdout.buffer.write(b"\\xe4\\xbd\\xa0\\xff")\n'],shellmode=False)
+        self.assertEqual(r.exitcode,0)
+        self.assertEqual(r.stdout,u'\u4f60\u00ff')
+        stime = time.time()
+        self.assertRaises(CmdTimeoutError,run_cmd_capture,['%s'%(sys.executable),'-c','import time\ntime.sleep(5)\n'],shellmode=False,timeout=0.2)
+        self.assertTrue((time.time() - stime) < 2.0)
+        return
+
+    def test_A044(self):
+        script = 'import sys\nfor i in range(200):\n    sys.stdout.write("out%d\\n" % i)\n    sys.stderr.write("err%d\\n" % i)\n    sys.stdout.flush()\n    sys.stderr.flush()\n'
+        cmds = ['%s'%(sys.executable),'-c',script]
+        outs = []
+        with run_cmd_output(cmds,True,True,shellmode=False,tagged=True,timestamps=True) as cmdobj:
+            for item in cmdobj.iter_lines(streams=['stdout']):
+                self.assertTrue(isinstance(item,CmdStreamItem))
+                self.assertEqual(item.stream,'stdout')
+                self.assertTrue(item.ts is not None)
+                outs.append(item.data)
+            errs = cmdobj.get_lines(5.0,200,streams=['stderr'])
+            self.assertEqual(cmdobj.get_lines(0.1,1,streams=['stdout']),[])
+            self.assertEqual(cmdobj.get_exitcode(),0)
+        self.assertEqual(outs,['out%d\n'%(i) for i in range(200)])
+        self.assertEqual([e.stream for e in errs],['stderr'] * 200)
+        self.assertEqual([e.data for e in errs],['err%d\n'%(i) for i in range(200)])
+        # untagged output keeps plain lines
+        lines = []
+        for l in run_cmd_output(cmds,True,True,shellmode=False):
+            lines.append(l)
+        self.assertEqual(sorted(lines),sorted(outs + [e.data for e in errs]))
+        errs = []
+        for l in run_cmd_output(cmds,True,True,shellmode=False).iter_lines(streams=('stderr',)):
+            errs.append(l)
+        self.assertEqual(errs,['err%d\n'%(i) for i in range(200)])
+        cmdobj = run_cmd_output(cmds,True,False,shellmode=False)
+        self.assertEqual(cmdobj.get_lines(1.0,1,streams=['stderr']),[])
+        self.assertEqual(len(list(cmdobj)),200)
+        self.assertEqual(cmdobj.get_exitcode(),0)
+        return
+
+    def test_A045(self):
+        if sys.platform.lower() == 'win32':
+            return
+        gen = ['%s'%(sys.executable),'-c','import sys\nfor i in range(1000):\n    sys.stdout.write("line%d\\n" % i)\nsys.exit(3)\n']
+        odd = ['%s'%(sys.executable),'-c','import sys\nfor l in sys.stdin:\n    if int(l[4:]) % 2 == 1:\n        sys.stdout.write(l)\n']
+        upper = ['%s'%(sys.executable),'-c','import sys\nfor l in sys.stdin:\n    sys.stdout.write(l.upper())\n']
+        for launcher in ['spawn','popen']:
+            cmdobj = pipeline([gen,odd,upper],shellmode=False,launcher=launcher)
+            rlines = []
+            for l in cmdobj:
+                rlines.append(l)
+            self.assertEqual(rlines,['LINE%d\n'%(i) for i in range(1,1000,2)])
+            self.assertEqual(cmdobj.get_exitcodes(),[3,0,0])
+            self.assertEqual(cmdobj.get_exitcode(),0)
+        cmdobj = run_cmd_output(gen,shellmode=False)
+        self.assertEqual(len(list(cmdobj)),1000)
+        self.assertEqual(cmdobj.get_exitcodes(),[3])
+        sleep = ['%s'%(sys.executable),'-c','import time\ntime.sleep(5)\n']
+        attr = CmdObjectAttr()
+        attr.maxwtime = 0.2
+        # the whole chain is killed by the attr
+        stime = time.time()
+        cmdobj = pipeline([sleep,upper],shellmode=False)
+        self.assertEqual(cmdobj.get_exitcodes(attr),[-signal.SIGKILL,-signal.SIGKILL])
+        self.assertTrue((time.time() - stime) < 2.0)
+        # the last stage is done, but the first still runs
+        stime = time.time()
+        cmdobj = pipeline([sleep,['%s'%(sys.executable),'-c','print("done")']],shellmode=False)
+        self.assertEqual(cmdobj.get_lines(5.0,1),['done\n'])
+        self.assertTrue(cmdobj.is_running())
+        self.assertEqual(cmdobj.get_exitcodes(attr),[-signal.SIGKILL,0])
+        self.assertTrue((time.time() - stime) < 2.0)
+        with pipeline([sleep,upper],shellmode=False) as cmdobj:
+            self.assertRaises(CmdTimeoutError,cmdobj.get_exitcode,None,0.1)
+        self.assertEqual(cmdobj.get_exitcodes(),[-signal.SIGKILL,-signal.SIGKILL])
+        self.assertRaises(Exception,pipeline,[])
+        return
+
+    def test_A046(self):
+        badcmds = ['%s'%(sys.executable),'-c','import sys\nsys.stdout.buffer.write(b"ok\\n\\xff\\n")\n']
+        okcmds = ['%s'%(sys.executable),'-c','print("hello")']
+        for reader in ['thread','selector','shared']:
+            cmdobj = run_cmd_output(badcmds,shellmode=False,reader=reader,encoding='ascii')
+            ok = False
+            rlines = []
+            try:
+                for l in cmdobj:
+                    rlines.append(l)
+            except UnicodeDecodeError:
+                ok = True
+            self.assertTrue(ok)
+            self.assertEqual(cmdobj.get_exitcode(),0)
+            # the reader is still there for the others
+            for i in range(3):
+                self.assertEqual(list(run_cmd_output(okcmds,shellmode=False,reader=reader)),['hello\n'])
+            # the lines before the bad byte are given first
+            self.assertEqual(rlines,['ok\n'])
+        # the child writes on after the error, it must not block on the pipe
+        cmds = ['%s'%(sys.executable),'-c','import sys\nsys.stdout.buffer.write(b"\\xff\\n" + b"x" * 1000000)\n']
+        cmdobj = run_cmd_output(cmds,shellmode=False,encoding='ascii')
+        self.assertRaises(UnicodeDecodeError,list,cmdobj)
+        stime = time.time()
+        cmdobj.get_exitcode()
+        self.assertTrue((time.time() - stime) < 5.0)
+        return
+
+    def test_A047(self):
+        cmds = ['%s'%(sys.executable),'-c','import sys\nsys.stdout.buffer.write(b"ok\\nline2\\nab\\xe4\\xbd" + b"\\xff" * 100000 + b"\\nend\\n")\n']
+        for reader in ['thread','selector']:
+            cmdobj = run_cmd_output(cmds,shellmode=False,reader=reader,encoding='UTF-8')
+            self.assertEqual(cmdobj.get_lines(5.0,2),['ok\n','line2\n'])
+            self.assertEqual(cmdobj.get_lines(5.0,1),['ab'])
+            self.assertRaises(UnicodeDecodeError,cmdobj.get_lines,5.0,1)
+            self.assertEqual(cmdobj.get_lines(0.1,1),[])
+            # the pipe is read to the end, so the child is not blocked
+            self.assertEqual(cmdobj.get_exitcode(),0)
+        r = run_cmd_capture(cmds,shellmode=False,encoding='UTF-8')
+        self.assertEqual(r.exitcode,0)
+        self.assertRaises(UnicodeDecodeError,getattr,r,'stdout')
+        if sys.version_info < (3,5):
+            return
+        try:
+            from cmdpack import aio as cmdpack_aio
+        except ImportError:
+            import aio as cmdpack_aio
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            p = loop.run_until_complete(cmdpack_aio.run_cmd_output(cmds,shellmode=False,encoding='UTF-8'))
+            self.assertEqual(loop.run_until_complete(p.get_lines(5.0,3)),['ok\n','line2\n','ab'])
+            self.assertRaises(UnicodeDecodeError,loop.run_until_complete,p.get_lines(5.0,1))
+            self.assertEqual(loop.run_until_complete(p.get_exitcode()),0)
+        finally:
+            loop.close()
+        return
+
+    def test_A048(self):
+        if sys.platform.lower() == 'win32':
+            return
+        cmds = ['%s'%(sys.executable),'-c','import os\nprint("%d %d %d" % (os.getpid(),os.getpgid(0),os.getsid(0)))\n']
+        for launcher in ['popen','spawn']:
+            rlines = list(run_cmd_output(cmds,shellmode=False,newpgrp=True,launcher=launcher))
+            pid,pgid,sid = [int(x) for x in rlines[0].split()]
+            # a new process group in our session, not a new session
+            self.assertEqual(pgid,pid)
+            self.assertEqual(sid,os.getsid(0))
+            rlines = list(run_cmd_output(cmds,shellmode=False,launcher=launcher))
+            pid,pgid,sid = [int(x) for x in rlines[0].split()]
+            self.assertEqual(pgid,os.getpgid(0))
+        return
+
+    def test_A049(self):
+        if futures is None:
+            return
+        tempd = make_tempdir()
+        files = [os.path.join(tempd,'job%d'%(i)) for i in range(3)]
+        try:
+            with CommandPool(2) as pool:
+                # the jobs run before the results are asked for
+                results = pool.map([['%s'%(sys.executable),'-c','open(%r,"w").close()'%(f)] for f in files],shellmode=False)
+                stime = time.time()
+                while (time.time() - stime) < 5.0 and not all([os.path.exists(f) for f in files]):
+                    time.sleep(0.05)
+                self.assertTrue(all([os.path.exists(f) for f in files]))
+                self.assertEqual([r.exitcode for r in results],[0,0,0])
+                # a child runs on after closing stdout, the other jobs are not held by it
+                slow = pool.submit(['%s'%(sys.executable),'-c','import os,time\nos.close(1)\ntime.sleep(3)\n'],shellmode=False)
+                time.sleep(0.2)
+                stime = time.time()
+                fs = [pool.submit(['%s'%(sys.executable),'-c','print("job%d")'%(i)],shellmode=False) for i in range(3)]
+                self.assertEqual([f.result(2.5).lines for f in fs],[['job%d\n'%(i)] for i in range(3)])
+                self.assertTrue((time.time() - stime) < 2.5)
+                self.assertFalse(slow.done())
+                self.assertEqual(slow.result(10).exitcode,0)
+        finally:
+            for f in files:
+                if os.path.exists(f):
+                    os.remove(f)
+            os.rmdir(tempd)
+        return
+
+    def test_A050(self):
+        if not sys.platform.lower().startswith('linux') or not hasattr(os,'posix_spawnp'):
+            return
+        # spawn only when asked for
+        p = run_read_cmd(['true'],stdoutfile=None,stderrfile=None,shellmode=False)
+        self.assertTrue(isinstance(p,subprocess.Popen))
+        self.assertEqual(p.wait(),0)
+        rfd,wfd = os.pipe()
+        os.dup2(rfd,100)
+        os.set_inheritable(100,True)
+        try:
+            for launcher in ['popen','spawn']:
+                # python ignores SIGPIPE itself, so look at the ignored signals of grep
+                rlines = list(run_cmd_output(['grep','SigIgn','/proc/self/status'],shellmode=False,launcher=launcher))
+                sigign = int(rlines[0].split()[1],16)
+                self.assertEqual(sigign & ((1 << (signal.SIGPIPE - 1)) | (1 << (signal.SIGXFSZ - 1))),0)
+                rlines = list(run_cmd_output(['ls','/proc/self/fd'],shellmode=False,launcher=launcher))
+                self.assertFalse('100\n' in rlines)
+        finally:
+            os.close(100)
+            os.close(rfd)
+            os.close(wfd)
+        cmdobj = pipeline([['yes'],['head','-n','2']],shellmode=False,launcher='spawn')
+        self.assertEqual(list(cmdobj),['y\n','y\n'])
+        self.assertEqual(cmdobj.get_exitcodes(),[-signal.SIGPIPE,0])
+        # our fd of the same number as the child one is not changed
+        inherit = os.get_inheritable(2)
+        os.set_inheritable(2,False)
+        try:
+            p = run_read_cmd(['true'],stdoutfile=None,stderrfile=2,shellmode=False,launcher='spawn')
+            self.assertEqual(p.wait(),0)
+            self.assertFalse(os.get_inheritable(2))
+        finally:
+            os.set_inheritable(2,inherit)
+        return
+
+    def test_A051(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append('-c')
+        cmds.append('import sys\nsys.stdout.write("out1\\nout2\\n")\nsys.stdout.flush()\nsys.stderr.write("err1\\nerr2\\nerr3\\n")\nsys.exit(2)\n')
+        outfd,outfile = tempfile.mkstemp()
+        errfd,errfile = tempfile.mkstemp()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saveout = os.dup(1)
+        saveerr = os.dup(2)
+        msg = None
+        try:
+            os.dup2(outfd,1)
+            os.dup2(errfd,2)
+            try:
+                run_cmd_wait(cmds,noout=0,shellmode=False,tail=2)
+            except Exception as e:
+                msg = str(e)
+        finally:
+            os.dup2(saveout,1)
+            os.dup2(saveerr,2)
+            os.close(saveout)
+            os.close(saveerr)
+            os.close(outfd)
+            os.close(errfd)
+        try:
+            # the output is still shown with noout=0, the tail has the end of stderr
+            self.assertTrue(msg is not None and msg.endswith('\nerr2\nerr3\n'))
+            self.assertEqual(self.__read_file_bytes(outfile),b'out1\nout2\n')
+            # our own log may also go to stderr with -v
+            self.assertTrue(b'err1\nerr2\nerr3\n' in self.__read_file_bytes(errfile))
+        finally:
+            os.remove(outfile)
+            os.remove(errfile)
+        # tail_bytes counts the encoded bytes
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append('-c')
+        cmds.append('import sys\nsys.stdout.buffer.write(b"x\\xc3\\xa9\\ny\\xc3\\xa9\\n")\n')
+        p = run_cmd_output(cmds,shellmode=False,encoding='UTF-8',tail_bytes=4)
+        self.assertEqual(p.get_exitcode(),0)
+        self.assertEqual(p.get_tail(),[u'y\xe9\n'])
+        p = run_cmd_output(cmds,shellmode=False,encoding='UTF-8',tail_bytes=3)
+        self.assertEqual(p.get_exitcode(),0)
+        self.assertEqual(p.get_tail(),[u'\xe9\n'])
+        return
+
+    def test_A052(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append('-c')
+        cmds.append('import sys\nfor i in range(5000):\n    sys.stdout.write("line%d\\n"%(i))\n')
+        alls = ''.join(['line%d\n'%(i) for i in range(5000)])
+        tempf = make_tempfile()
+        rfd,wfd = os.pipe()
+        os.close(rfd)
+        try:
+            # the broken sink is left out, the other sink and the lines go on
+            rlines = []
+            for l in run_cmd_output(cmds,shellmode=False,tee=[wfd,tempf]):
+                rlines.append(l)
+            self.assertEqual(''.join(rlines),alls)
+            self.assertEqual(self.__read_file_bytes(tempf),alls.encode('UTF-8'))
+            if hasattr(os,'splice'):
+                # a splice error other than EINVAL is not hidden as an end of the output
+                p = run_cmd_output(cmds,shellmode=False,tee=wfd,forward='none')
+                ok = False
+                try:
+                    for l in p:
+                        pass
+                except OSError:
+                    ok = True
+                self.assertTrue(ok)
+                p.get_exitcode()
+            if sys.platform.lower().startswith('linux'):
+                # a bad tee or forward starts no child
+                childs = get_child_pids(os.getpid())
+                fds = os.listdir('/proc/self/fd')
+                for tee,forward in [(tempf,'('),(os.path.join(tempf,'no','such'),None)]:
+                    ok = False
+                    try:
+                        run_cmd_output(cmds,shellmode=False,tee=tee,forward=forward)
+                    except Exception:
+                        ok = True
+                    self.assertTrue(ok)
+                self.assertEqual(get_child_pids(os.getpid()),childs)
+                self.assertTrue(len(os.listdir('/proc/self/fd')) <= len(fds))
+        finally:
+            os.close(wfd)
+            os.remove(tempf)
+        return
+
+    def __a053_gone(self,pid):
+        etime = time.time() + 2.0
+        while time.time() < etime:
+            try:
+                with open('/proc/%d/stat'%(pid),'r') as fin:
+                    if fin.read().rsplit(')',1)[1].split()[0] == 'Z':
+                        return True
+            except IOError:
+                return True
+            time.sleep(0.05)
+        return False
+
+    def test_A053(self):
+        if not sys.platform.lower().startswith('linux'):
+            return
+        # the child exits at once, its sleep keeps the pipe open
+        cmds = ['%s'%(sys.executable),'-c','import subprocess,sys,time\np = subprocess.Popen(["sleep","30"])\nsys.stdout.write("%d\\n"%(p.pid))\nsys.stdout.flush()\ntime.sleep(0.5)\n']
+        attr = CmdObjectAttr()
+        attr.maxwtime = 1.0
+        stime = time.time()
+        cmdobj = run_cmd_output(cmds,shellmode=False)
+        rlines = cmdobj.get_lines(5.0,1)
+        self.assertEqual(len(rlines),1)
+        gpid = int(rlines[0])
+        # the reaped pid is not signalled, the sleep seen before is
+        self.assertEqual(cmdobj.get_exitcode(attr),0)
+        self.assertTrue((time.time() - stime) < 5.0)
+        self.assertTrue(self.__a053_gone(gpid))
+        return
+
+    def test_A054(self):
+        # the pipes are closed long before the exit
+        cmds = ['%s'%(sys.executable),'-c','import os,time\nos.write(1,b"closed\\n")\nos.close(1)\nos.close(2)\ntime.sleep(30)\n']
+        stime = time.time()
+        self.assertRaises(CmdTimeoutError,run_cmd_capture,cmds,shellmode=False,timeout=0.5)
+        self.assertTrue((time.time() - stime) < 5.0)
+        res = run_cmd_capture(['%s'%(sys.executable),'-c','import os,time\nos.close(1)\ntime.sleep(0.2)\n'],shellmode=False,timeout=5.0)
+        self.assertEqual(res.exitcode,0)
+        return
+
+    def test_A055(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append('-c')
+        cmds.append('import sys\nfor i in range(2000):\n    sys.stderr.write("err%d\\n"%(i))\nsys.stderr.flush()\nfor i in range(2000):\n    sys.stdout.write("out%d\\n"%(i))\n')
+        readers = ['thread']
+        if selectors is not None and sys.platform.lower() != 'win32':
+            readers.extend(['selector','shared'])
+        for reader in readers:
+            for maxbytes,maxlines in [(None,10),(100,None)]:
+                # the stderr lines wait for their reader, stdout still goes on
+                cmdobj = run_cmd_output(cmds,True,True,shellmode=False,reader=reader,max_buffered_bytes=maxbytes,max_buffered_lines=maxlines)
+                outs = []
+                for l in cmdobj.iter_lines(streams=['stdout']):
+                    outs.append(l)
+                self.assertEqual(outs,['out%d\n'%(i) for i in range(2000)])
+                errs = []
+                for l in cmdobj.iter_lines(streams=['stderr']):
+                    errs.append(l)
+                self.assertEqual(errs,['err%d\n'%(i) for i in range(2000)])
+                self.assertEqual(cmdobj.get_exitcode(),0)
+        return
+
+    def test_A056(self):
+        if sys.platform.lower() == 'win32':
+            return
+        # the builtins of /bin/sh give the same as with the shell
+        for cmds in [['echo','a\\nb'],['printf','%s\\n','a','b'],['test','-d','/'],['[','-d','/',']'],['pwd'],['true'],['false']]:
+            cmdobj = run_cmd_output(cmds,directmode=False)
+            shells = list(cmdobj)
+            shellcode = cmdobj.get_exitcode()
+            cmdobj = run_cmd_output(cmds)
+            self.assertEqual(list(cmdobj),shells)
+            self.assertEqual(cmdobj.get_exitcode(),shellcode)
+        return
+
+    def test_A057(self):
+        if not sys.platform.lower().startswith('linux'):
+            return
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append('-c')
+        cmds.append('import os,sys\nsys.stdout.write("%d\\n"%(os.getpid()))\nfor i in range(200000):\n    sys.stdout.write("line%d\\n"%(i))\n')
+        readers = ['thread']
+        if selectors is not None:
+            readers.extend(['selector','shared'])
+        for reader in readers:
+            for maxbytes,maxlines in [(None,10),(100,None)]:
+                nthreads = threading.active_count()
+                p = run_cmd_output(cmds,shellmode=False,reader=reader,max_buffered_bytes=maxbytes,max_buffered_lines=maxlines)
+                rlines = p.get_lines(5.0,1,1)
+                pid = int(rlines[0])
+                # dropped with its output not read, the rest goes nowhere and the child ends
+                del p
+                gc.collect()
+                etime = time.time() + 10.0
+                while os.path.exists('/proc/%d'%(pid)) and time.time() < etime:
+                    time.sleep(0.05)
+                self.assertFalse(os.path.exists('/proc/%d'%(pid)))
+                while threading.active_count() > nthreads and time.time() < etime:
+                    time.sleep(0.05)
+                self.assertTrue(threading.active_count() <= nthreads)
+        return
+
+    def test_A058(self):
+        cmds = []
+        cmds.append('%s'%(sys.executable))
+        cmds.append('-c')
+        cmds.append('import sys\nsys.stdout.buffer.write((u"\\u4f60" * 1000 + u"\\n").encode("UTF-8") * 5)\n')
+        for reader in ['thread','selector']:
+            if reader != 'thread' and (selectors is None or sys.platform.lower() == 'win32'):
+                continue
+            p = run_cmd_output(cmds,shellmode=False,reader=reader,encoding='UTF-8',max_buffered_bytes=1000000)
+            # nothing taken, all the output waits in the buffer
+            time.sleep(0.5)
+            # the bytes of the pipe, not the decoded chars
+            self.assertEqual(p.highwaterbytes,15005)
+            self.assertEqual(list(p),[u'\u4f60' * 1000 + u'\n'] * 5)
+            self.assertEqual(p.get_exitcode(),0)
+        return
+
 
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),'..','..')))
@@ -1415,6 +4281,9 @@ def main():
     elif len(sys.argv) > 1 and sys.argv[1] == 'norettimeerr':
         norettime_err(sys.argv[2:])
         return
+    elif len(sys.argv) > 1 and sys.argv[1] == 'noretbytesout':
+        noretbytes_out(sys.argv[2:])
+        return
 
     if '--release' in sys.argv[1:]:
         debug_release()
@@ -0,0 +1,216 @@
+#!/usr/bin/python
+
+import os
+import sys
+import time
+import signal
+import asyncio
+import collections
+try:
+    from . import format_list_to_shell_cmd,get_child_pids,_CmdStreamDecoder,_LoggerObject
+except ImportError:
+    from __init_debug__ import format_list_to_shell_cmd,get_child_pids,_CmdStreamDecoder,_LoggerObject
+
+
+class AioCmdRunObject(_LoggerObject):
+    def __init__(self,proc,autoclosefds=[],linebuf=True,encoding=None,errors='strict',binary=False):
+        super(AioCmdRunObject,self).__init__('cmdpack')
+        self.__proc = proc
+        self.__closefiles = autoclosefds
+        self.__linebuf = linebuf
+        self.__lines = collections.deque()
+        self.__event = asyncio.Event()
+        self.__tasks = []
+        self.__retcode = None
+        self.__readerror = None
+        self.outended = True
+        self.errended = True
+        if proc.stdout is not None:
+            self.outended = False
+            self.__tasks.append(asyncio.ensure_future(self.__read_stream(proc.stdout,'stdout',self.__get_decoder(encoding,errors,binary))))
+        if proc.stderr is not None:
+            self.errended = False
+            self.__tasks.append(asyncio.ensure_future(self.__read_stream(proc.stderr,'stderr',self.__get_decoder(encoding,errors,binary))))
+        return
+
+    def __get_decoder(self,encoding,errors,binary):
+        if binary:
+            return None
+        fallback = None
+        if encoding is None:
+            encoding = 'UTF-8'
+            if errors == 'strict':
+                fallback = 'latin-1'
+        return _CmdStreamDecoder(encoding,errors,fallback)
+
+    def __split_lines(self,leftover,data,final):
+        if leftover is not None:
+            data = leftover + data
+        if not self.__linebuf:
+            if len(data) > 0:
+                self.__lines.append(data)
+            return None
+        nl = '\n'
+        if not isinstance(data,str):
+            nl = b'\n'
+        parts = data.split(nl)
+        last = parts.pop()
+        for l in parts:
+            self.__lines.append(l + nl)
+        if len(last) > 0:
+            if final:
+                self.__lines.append(last)
+            else:
+                return last
+        return None
+
+    async def __read_stream(self,stream,description,decoder):
+        leftover = None
+        while True:
+            data = await stream.read(65536)
+            final = (len(data) == 0)
+            if decoder is not None:
+                data = decoder.decode(data,final)
+                error = decoder.pop_error()
+                if error is not None and self.__readerror is None:
+                    # read on to the end, the error goes to the consumer at eof
+                    self.__readerror = error
+            leftover = self.__split_lines(leftover,data,final)
+            if final:
+                break
+            self.__event.set()
+        if description == 'stdout':
+            self.outended = True
+        else:
+            self.errended = True
+        self.__event.set()
+        return
+
+    def __pop_lines(self,retlines,maxlines=None):
+        cnt = len(self.__lines)
+        if maxlines is not None and (maxlines - len(retlines)) < cnt:
+            cnt = maxlines - len(retlines)
+        while cnt > 0:
+            retlines.append(self.__lines.popleft())
+            cnt -= 1
+        return
+
+    async def __wait_lines(self,etime=None,minlines=1,maxlines=None):
+        retlines = []
+        while len(retlines) < minlines:
+            self.__pop_lines(retlines,maxlines)
+            if len(retlines) >= minlines:
+                break
+            if self.outended and self.errended and len(self.__lines) == 0:
+                break
+            self.__event.clear()
+            if etime is None:
+                await self.__event.wait()
+                continue
+            ctime = time.time()
+            if ctime >= etime:
+                break
+            try:
+                await asyncio.wait_for(self.__event.wait(),etime - ctime)
+            except asyncio.TimeoutError:
+                pass
+        return retlines
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        rlines = await self.__wait_lines(None,1,1)
+        if len(rlines) == 0:
+            await self.get_exitcode()
+            self.__raise_read_error()
+            raise StopAsyncIteration
+        return rlines[0]
+
+    def __raise_read_error(self):
+        error = self.__readerror
+        if error is not None and self.outended and self.errended and len(self.__lines) == 0:
+            self.__readerror = None
+            raise error
+        return
+
+    async def get_lines(self,timeout=1.0,minlines=1,maxlines=None):
+        if maxlines is None or maxlines < minlines:
+            maxlines = minlines
+        rlines = await self.__wait_lines(time.time() + timeout,minlines,maxlines)
+        if len(rlines) == 0:
+            self.__raise_read_error()
+        return rlines
+
+    async def __kill_proc_childs(self,pid):
+        cpids = []
+        if sys.platform.lower() != 'win32':
+            # it reads /proc or runs ps, so keep it off the event loop
+            loop = asyncio.get_event_loop()
+            cpids = await loop.run_in_executor(None,get_child_pids,pid)
+        try:
+            self.__proc.kill()
+        except ProcessLookupError:
+            pass
+        for p in cpids:
+            try:
+                os.kill(p,signal.SIGKILL)
+            except OSError as e:
+                self.info('kill [%s] error [%s]',p,e)
+        return
+
+    async def get_exitcode(self,attr=None):
+        if self.__retcode is not None:
+            return self.__retcode
+        maxwtime = None
+        if attr is not None:
+            maxwtime = attr.maxwtime
+        if len(self.__tasks) > 0:
+            done,pending = await asyncio.wait(self.__tasks,timeout=maxwtime)
+            if len(pending) > 0:
+                self.info('kill [%s]',self.__proc.pid)
+                await self.__kill_proc_childs(self.__proc.pid)
+                await asyncio.wait(pending)
+            self.__tasks = []
+        self.__retcode = await self.__proc.wait()
+        for f in self.__closefiles:
+            f.close()
+        self.__closefiles = []
+        self.info('exitcode (%s)',self.__retcode)
+        return self.__retcode
+
+    def is_running(self):
+        return self.__retcode is None and self.__proc.returncode is None
+
+
+def __get_stream_file(out,autoclosefds):
+    if isinstance(out,bool):
+        if out:
+            return asyncio.subprocess.PIPE
+        return asyncio.subprocess.DEVNULL
+    elif isinstance(out,str):
+        f = open(out,'wb')
+        autoclosefds.append(f)
+        return f
+    return out
+
+async def run_cmd_output(cmd,stdout=True,stderr=False,shellmode=True,copyenv=None,linebuf=True,encoding=None,errors='strict',binary=False):
+    autoclosefds = []
+    stdoutfile = __get_stream_file(stdout,autoclosefds)
+    stderrfile = __get_stream_file(stderr,autoclosefds)
+    try:
+        if shellmode:
+            cmds = cmd
+            if isinstance(cmd,list):
+                cmds = format_list_to_shell_cmd(cmd)
+            proc = await asyncio.create_subprocess_shell(cmds,stdout=stdoutfile,stderr=stderrfile,env=copyenv)
+        else:
+            cmds = cmd
+            if not isinstance(cmd,list):
+                cmds = [cmd]
+            proc = await asyncio.create_subprocess_exec(*cmds,stdout=stdoutfile,stderr=stderrfile,env=copyenv)
+    except:
+        for f in autoclosefds:
+            f.close()
+        raise
+    return AioCmdRunObject(proc,autoclosefds,linebuf,encoding,errors,binary)
@@ -37,9 +37,24 @@ import rtools
 import tempfile
 import subprocess
 import platform
+import codecs
 import random
 import time
+import threading
+import signal
+import gc
+try:
+    import concurrent.futures as futures
+except ImportError:
+    futures = None
+try:
+    import selectors
+except ImportError:
+    selectors = None
 from cmdpack import run_cmd_wait,run_read_cmd,run_command_callback,run_cmd_output,CmdObjectAttr
+from cmdpack import get_child_pids,ProcTreeSnapshot,CommandPool,shell_quote_string,format_list_to_shell_cmd
+from cmdpack import SpawnPopen,set_launcher,_LoggerObject,configure_logging,CmdTimeoutError,_CmdReaper
+from cmdpack import run_cmd_capture,CmdCaptureResult,CmdStreamItem,pipeline
 from cmdpack import __version__ as cmdpack_version
 from cmdpack import __version_info__ as cmdpack_version_info
 
@@ -188,6 +203,10 @@ def norettimeerr_handler(args,parser):
 	noret_put(float(args.subnargs[0]),args.subnargs[1:],sys.stderr)
 	return
 
+def noretbytesout_handler(args,parser):
+	noretbytes_out(args.subnargs)
+	return
+
 	
 def main():
 	outputfile_orig = os.path.join(os.path.dirname(os.path.abspath(__file__)),'release.py')
@@ -230,6 +249,9 @@ def main():
 			},
 			"norettimeerr<norettimeerr_handler>" : {
 				"$" : "+"
+			},
+			"noretbytesout<noretbytesout_handler>" : {
+				"$" : "+"
 			}
 		}
 	'''